@@ -24,9 +24,20 @@ adb push /etc/hosts /system/etc/hosts
 # Prepare redirection between host and emulator
 adb reverse tcp:80 tcp:80
 
-# Server might take some time to appear so waiting for it
+# The server only listens once the recording is indexed, and answers on /__shift/ready from then on
 echo "Waiting for the server to start"
-sleep 15
+SERVER_START_TIMEOUT=${SERVER_START_TIMEOUT:-300}
+waited=0
+while ! curl -sf --max-time 5 http://localhost/__shift/ready > /dev/null; do
+    if [ "$waited" -ge "$SERVER_START_TIMEOUT" ]; then
+        echo "The server did not start within ${SERVER_START_TIMEOUT}s, see /home/androidusr/server/logs.txt"
+        exit 1
+    fi
+    echo "Waiting for the server to start..."
+    sleep 1
+    waited=$((waited + 1))
+done
+echo "Server started"
 
 # Ready for the automation
 echo "Starting appium automation"
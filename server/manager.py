@@ -1,28 +1,52 @@
 import multiprocessing
 import shutil
 import argparse
-import os
 import json
+import logging
+import os
+import sys
 
 from proto.http.app import run_http
+from proto.http.bench import BENCH_MODES, run_bench
+from proto.http.pcap_import import import_pcap
 from proto.http.server import run_server
-
-
-def run_servers(app_name):
-    """Launch service listeners for a specific app."""
+from proto.http.serving import SERVE_MODES
+from proto.http.sessions import ROUTE_MODES, run_multi_server
+from services.junit_writer import find_shard_reports, merge_reports
+from services.log_service import setup_logging
+from services.recording_layers import compact_recording
+from services.recording_store import RECORDING_FORMATS, convert_recording, iter_recording
+from services.run_log import RunLogReader, export_run_log
+
+logger = logging.getLogger('manager')
+
+
+def run_servers(app_name, serve_mode='dev', threads=8, latency='off', shard_by=None, recapture=False):
+    """Launch service listeners for a specific app.
+    With shard_by ('client' or 'header'), every device replays the recording in its own session (shard).
+    Devices reaching the server through adb reverse all connect from 127.0.0.1 and share one 'client' shard,
+    they need to send the X-Shift-Session header and use 'header' sharding instead.
+    With recapture, an app already recorded is captured again into a delta layer."""
     # Check the environment variable
     stage = os.getenv("STAGE", "DEV")
-    print(f"STAGE environment variable: {stage}")
+    logger.info("STAGE environment variable: %s", stage)
     # Start the HTTP process only if ENVIRONNEMENT is set to "DEV"
     http_process = None
     if stage == "DEV":
-        http_process = multiprocessing.Process(target=run_http, args=(app_name,))
+        http_process = multiprocessing.Process(target=run_http, args=(app_name, recapture))
         http_process.start()
 
     # Always start the server process
     http_server_answer = None
-    if stage == "CI":
-        http_server_answer = multiprocessing.Process(target=run_server, args=(app_name,))
+    if stage == "CI" and shard_by:
+        http_server_answer = multiprocessing.Process(target=run_multi_server, args=([app_name],),
+                                                     kwargs={'route': shard_by, 'serve_mode': serve_mode,
+                                                             'threads': threads})
+        http_server_answer.start()
+    elif stage == "CI":
+        http_server_answer = multiprocessing.Process(target=run_server, args=(app_name,),
+                                                     kwargs={'serve_mode': serve_mode, 'threads': threads,
+                                                             'latency': latency})
         http_server_answer.start()
 
     # Wait for the processes to finish
@@ -39,13 +63,47 @@ def clear_all():
     return "Cleared every datas"
 
 
-def update_hosts(packet_directory, host='0.0.0.0'):
-    packet_directory = "resources/http/" + packet_directory
-
-    with open(packet_directory + "/packets.json", 'r') as f:
-        packets = json.load(f)
-    domain = packets[0]['request']['headers']['Host']
-    print(f"Setting up domain: {domain}")
+def show_run_log(run_path, entry=None, export=None):
+    """Print an exchange of a run log, or export the whole log to one JSON file per exchange"""
+    if export:
+        count = export_run_log(run_path, export)
+        logger.info("Exported %d exchanges to %s", count, export)
+        return
+    reader = RunLogReader(run_path)
+    if entry is not None:
+        sys.stdout.write(json.dumps(reader[entry], ensure_ascii=False, indent=4) + '\n')
+    else:
+        sys.stdout.write(f"{len(reader)} exchanges in {reader.file_path}\n")
+    reader.close()
+
+
+def merge_run_reports(app_name, run_id=None, output=None):
+    """Merge the reports of the shards of a replay run, the latest run by default"""
+    diff_path = os.path.join('resources/http', app_name, 'diff')
+    if run_id is None:
+        runs = [entry for entry in os.listdir(diff_path) if entry.isdigit()]
+        if not runs:
+            logger.error("No replay run found in %s", diff_path)
+            return
+        run_id = max(runs, key=int)
+    run_path = os.path.join(diff_path, run_id)
+    output = output or os.path.join(run_path, 'junit_report.xml')
+    tests, failures = merge_reports(find_shard_reports(run_path), output)
+    logger.info("Merged report of run %s: %d tests, %d failures in %s", run_id, tests, failures, output)
+
+
+def update_hosts(packet_directories, host='0.0.0.0'):
+    if isinstance(packet_directories, str):
+        packet_directories = [packet_directories]
+
+    domains = []
+    for packet_directory in packet_directories:
+        packet_directory = "resources/http/" + packet_directory
+
+        first_packet = next(iter_recording(packet_directory))
+        domain = first_packet['request']['headers']['Host']
+        logger.info("Setting up domain: %s", domain)
+        domains.append(domain)
 
     last = None
     with open('/etc/hosts', 'r') as f:
@@ -53,9 +111,10 @@ def update_hosts(packet_directory, host='0.0.0.0'):
             last = line
 
     with open('/etc/hosts', 'w') as f:
-        f.write(f'127.0.0.1 localhost\n')
-        f.write(f'{host} {domain}\n')
-        f.write(f'{host} www.{domain}\n')
+        f.write('127.0.0.1 localhost\n')
+        for domain in domains:
+            f.write(f'{host} {domain}\n')
+            f.write(f'{host} www.{domain}\n')
         if last is not None:
             f.write(last)
 
@@ -71,18 +130,113 @@ if __name__ == '__main__':
 
     run_servers_parser = subparsers.add_parser("run_servers")
     run_servers_parser.add_argument("app_name", help="Name of the app to run services for")
+    run_servers_parser.add_argument("--serve-mode", choices=SERVE_MODES + ("async",), default="dev",
+                                    help="Server used for the replay app (default: Flask debug server)")
+    run_servers_parser.add_argument("--latency", default="off",
+                                    help="Recorded response times in async mode: off, real or a scale factor")
+    run_servers_parser.add_argument("--threads", type=int, default=8, help="Worker threads in waitress mode")
+    run_servers_parser.add_argument("--shard-by", choices=("client", "header"), default=None,
+                                    help="Replay in parallel from several devices, one shard per client address "
+                                         "or per X-Shift-Session header, with one merged report per run. Devices "
+                                         "behind adb reverse all connect from 127.0.0.1, shard them by header")
+    run_servers_parser.add_argument("--recapture", action="store_true",
+                                    help="Capture an app that already has a recording again, only storing the "
+                                         "new and changed exchanges in a delta layer")
+
+    run_multi_parser = subparsers.add_parser("run_multi")
+    run_multi_parser.add_argument("app_names", nargs="*", help="Apps to serve (default: every recording)")
+    run_multi_parser.add_argument("--route", choices=ROUTE_MODES, default="host",
+                                  help="How requests are routed to sessions")
+    run_multi_parser.add_argument("--idle-timeout", type=float, default=600.0,
+                                  help="Seconds after which an idle session is evicted")
+    run_multi_parser.add_argument("--serve-mode", choices=SERVE_MODES, default="threaded")
+    run_multi_parser.add_argument("--threads", type=int, default=8, help="Worker threads in waitress mode")
+    run_multi_parser.add_argument("--port", type=int, default=80)
 
     update_hosts_parser = subparsers.add_parser("update_hosts")
-    update_hosts_parser.add_argument("app_name", help="Name of the app to update hosts for")
+    update_hosts_parser.add_argument("app_name", nargs="+", help="Name of the apps to update hosts for")
+
+    import_pcap_parser = subparsers.add_parser("import_pcap")
+    import_pcap_parser.add_argument("app_name", help="Name of the app to build the recording for")
+    import_pcap_parser.add_argument("files", nargs="+", help="pcap or pcapng files to import")
+    import_pcap_parser.add_argument("--workers", type=int, default=1,
+                                    help="Worker processes, flows are split between them by hash")
+    import_pcap_parser.add_argument("--port", type=int, default=None,
+                                    help="Port of the HTTP server (guessed from the traffic when not given)")
+
+    convert_recording_parser = subparsers.add_parser("convert_recording")
+    convert_recording_parser.add_argument("app_name", nargs="+", help="Name of the apps to convert the recording of")
+    convert_recording_parser.add_argument("--format", choices=RECORDING_FORMATS, default="gzip",
+                                          help="Format of the converted recording (default: gzip)")
+
+    compact_recording_parser = subparsers.add_parser("compact_recording")
+    compact_recording_parser.add_argument("app_name", nargs="+", help="Name of the apps to merge the layers of")
+
+    run_log_parser = subparsers.add_parser("run_log")
+    run_log_parser.add_argument("run_path", help="Run directory (resources/http/<app>/diff/<run>) or run log file")
+    run_log_parser.add_argument("--entry", type=int, default=None, help="Print the exchange at this position")
+    run_log_parser.add_argument("--export", default=None,
+                                help="Directory to export the log to, one packet_<timestamp>.json per exchange")
+
+    merge_reports_parser = subparsers.add_parser("merge_reports")
+    merge_reports_parser.add_argument("app_name", help="App whose sharded replay reports are merged")
+    merge_reports_parser.add_argument("--run", default=None, help="Run to merge (default: the latest run)")
+    merge_reports_parser.add_argument("--output", default=None,
+                                      help="Merged report (default: junit_report.xml of the run directory)")
+
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("app_name", help="App to benchmark, its recording is synthesized if it has none")
+    bench_parser.add_argument("--synthesize", action="store_true",
+                              help="Use a synthetic recording even if the app has one")
+    bench_parser.add_argument("--exchanges", type=int, default=1000, help="Exchanges of the synthetic recording")
+    bench_parser.add_argument("--body-size", type=int, default=2048, help="Response body size in bytes")
+    bench_parser.add_argument("--binary-ratio", type=float, default=0.1, help="Share of binary responses")
+    bench_parser.add_argument("--cookies", type=int, default=5, help="Cookies per request and response")
+    bench_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    bench_parser.add_argument("--mode", choices=BENCH_MODES, default="both",
+                              help="Replay in-process, over loopback or both")
+    bench_parser.add_argument("--serve-mode", choices=tuple(m for m in SERVE_MODES if m != "dev") + ("async",),
+                              default="threaded", help="Server used for the loopback run")
+    bench_parser.add_argument("--threads", type=int, default=8, help="Worker threads in waitress mode")
+    bench_parser.add_argument("--output", default="bench_results.json", help="JSON file of the results")
+    bench_parser.add_argument("--workdir", default=None,
+                              help="Directory kept with the reports of the run (default: a temporary directory)")
 
     clear_all_parser = subparsers.add_parser("clear_all")
 
+    parser.add_argument("--log-level", default=None, choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Level of the logs (default: SHIFT_LOG_LEVEL or INFO)")
+
     args = parser.parse_args()
+    setup_logging(args.log_level)
 
     if args.command == "run_servers":
-        run_servers(args.app_name)
+        if args.shard_by and args.serve_mode == "async":
+            parser.error("--shard-by is not supported in async mode")
+        run_servers(args.app_name, args.serve_mode, args.threads, args.latency, args.shard_by, args.recapture)
+    elif args.command == "run_multi":
+        run_multi_server(args.app_names, port=args.port, route=args.route, idle_timeout=args.idle_timeout,
+                         serve_mode=args.serve_mode, threads=args.threads)
+    elif args.command == "import_pcap":
+        import_pcap(args.app_name, args.files, args.workers, args.port)
+    elif args.command == "convert_recording":
+        for app_name in args.app_name:
+            convert_recording("resources/http/" + app_name, args.format)
+    elif args.command == "compact_recording":
+        for app_name in args.app_name:
+            compact_recording("resources/http/" + app_name)
+    elif args.command == "run_log":
+        show_run_log(args.run_path, args.entry, args.export)
+    elif args.command == "merge_reports":
+        merge_run_reports(args.app_name, args.run, args.output)
+    elif args.command == "bench":
+        results = run_bench(args.app_name, args.exchanges, args.body_size, args.binary_ratio, args.cookies,
+                            args.concurrency, args.mode, args.serve_mode, args.threads, args.synthesize, args.output,
+                            args.workdir)
+        if results is None:
+            sys.exit(1)
     elif args.command == "clear_all":
-        print(clear_all())
+        logger.info(clear_all())
     elif args.command == "update_hosts":
         update_hosts(args.app_name)
     else:
@@ -1,22 +1,34 @@
 import xml.etree.ElementTree as ET
-from datetime import datetime
 import os
-import json
 import base64
+import logging
+import signal
+import sys
 from scapy.all import *
-from scapy.layers.http import HTTPRequest, HTTPResponse, HTTP
+from scapy.layers.http import HTTPRequest, HTTPResponse
 from scapy.layers.inet import TCP, IP
+from scapy.layers.l2 import CookedLinux, Ether
 from proto.http.request_service import decode_headers
-from collections import defaultdict
+from proto.http.tcp_reassembly import Exchange, TcpReassembler
+from services.log_service import setup_logging, truncate
+from services.pcap_writer import PcapStreamWriter
+from services.recording_layers import LayerWriter
+from services.recording_store import RecordingWriter, open_recording_writer
 
 # Global variables
 path = ''
 diff_path = None
 apk_name = ''
 testsuite: ET.Element = None
+pcap_writer: PcapStreamWriter = None
+recording_writer: RecordingWriter = None
+# Delta layer written instead of the recording when re-capturing an app
+layer_writer: LayerWriter = None
 
-# Dictionary to store TCP stream data
-tcp_streams = defaultdict(lambda: {"request": None, "response_headers": None, "response_body": b"", "packets": []})
+# Reassembles the HTTP exchanges of the sniffed TCP streams
+reassembler: TcpReassembler = None
+
+logger = logging.getLogger(__name__)
 
 
 def is_binary_content(headers):
@@ -48,7 +60,7 @@ def process_response_body(body, headers):
                 'encoding': 'utf-8',
                 'data': body.decode('utf-8', errors='replace')
             }
-    except Exception as e:
+    except Exception:
         # If we can't determine the type or decode properly, default to base64
         return {
             'encoding': 'base64',
@@ -56,130 +68,144 @@ def process_response_body(body, headers):
         }
 
 
-def save_packet(request_data, response_data, packets):
+def packet_record(request_data, response_data):
     """
-    Save packet data to a JSON file, handling binary data appropriately
+    Build the recording entry of an exchange, handling binary data appropriately
     """
-    global path
-    global diff_path
-
     # Process response body before saving
     if 'body' in response_data and isinstance(response_data['body'], (bytes, bytearray)):
         response_data['body'] = process_response_body(response_data['body'], response_data['headers'])
 
-    packet_data = []
-
-    file_name = f"packets.json"
-    file_path = os.path.join(path, file_name) if not diff_path else os.path.join(diff_path, file_name)
-
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-    if not os.path.isfile(file_path):
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write('[]')
-    else:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            packet_data = json.load(f)
-
-    packet_data.append({
+    return {
         'request': request_data,
         'response': response_data
-    })
-
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(packet_data, f, ensure_ascii=False, indent=4)
+    }
 
-    print(f"Packet saved to: {file_path}")
 
-    # Save packets to a pcap file
-    pcap_file_path = os.path.join(path, 'http.pcap')
-    wrpcap(pcap_file_path, packets, append=True)
+def save_packet(request_data, response_data, packets):
+    """
+    Append packet data to the recording, or to the delta layer when re-capturing
+    :return: How the exchange was stored, for the logs
+    """
+    global recording_writer
 
-    print(f"Packet pcap updated to: {pcap_file_path}")
+    record = packet_record(request_data, response_data)
+    if layer_writer is not None:
+        status, position = layer_writer.append(record)
+        outcome = status if position is None else f'{status}, packet {position} of the recording'
+    else:
+        if recording_writer is None:
+            recording_writer = open_recording_writer(path if not diff_path else diff_path, dedupe=True, blobs=True)
+        ref = recording_writer.append(record)
+        outcome = 'captured' if ref is None else f'captured, repeat of packet {ref}'
 
+    # Queue the raw frames of the exchange for the pcap file
+    if pcap_writer.enabled:
+        for timestamp, frame in packets:
+            pcap_writer.write(frame, timestamp)
+    return outcome
 
-def packet_callback(pak: Packet):
-    global tcp_streams
 
-    if pak.haslayer(TCP) and pak.haslayer(IP):
-        # Create a unique key for the TCP stream
-        stream_key = (pak[IP].src, pak[TCP].sport, pak[IP].dst, pak[TCP].dport)
-
-        # Track packets for this stream
-        if not pak.haslayer(HTTPRequest) and not pak.haslayer(HTTPResponse):
-            if pak.haslayer(Raw):
-                print(f"Adding packet to stream: {stream_key}")
-                tcp_streams[stream_key]["response_body"] += pak[Raw].load
-                tcp_streams[stream_key]["packets"].append(pak)
-
-        if pak.haslayer(HTTPRequest):
-            # Stream key is reversed for the response
-            stream_key = (pak[IP].dst, pak[TCP].dport, pak[IP].src, pak[TCP].sport)
-
-            # Handle HTTP request
-            http_layer = pak[HTTPRequest]
-            request_data = {
-                'source_ip': pak[IP].src,
-                'destination_ip': pak[IP].dst,
-                'source_port': pak[TCP].sport,
-                'destination_port': pak[TCP].dport,
-                'method': http_layer.Method.decode(),
-                'path': http_layer.Path.decode(),
-                'headers': decode_headers(http_layer.fields),
-            }
-            if pak.haslayer(Raw):
-                try:
-                    request_data['body'] = pak[Raw].load.decode()
-                except UnicodeDecodeError:
-                    # If request body is binary, encode it as base64
-                    request_data['body'] = {
-                        'encoding': 'base64',
-                        'data': base64.b64encode(pak[Raw].load).decode('utf-8')
-                    }
-            tcp_streams[stream_key]["request"] = request_data
-
-        elif pak.haslayer(HTTPResponse):
-            # Handle HTTP response headers
-            http_layer = pak[HTTPResponse]
-            response_data = {
-                'source_ip': pak[IP].src,
-                'destination_ip': pak[IP].dst,
-                'source_port': pak[TCP].sport,
-                'destination_port': pak[TCP].dport,
-                'status_code': http_layer.Status_Code.decode(),
-                'reason_phrase': http_layer.Reason_Phrase.decode(),
-                'headers': decode_headers(http_layer.fields),
+def exchange_to_packet(exchange: Exchange):
+    """
+    Convert a reassembled exchange into the recorded request and response data.
+    Heads are decoded with scapy so headers keep the field names of existing recordings.
+    """
+    request_layer = HTTPRequest(exchange.request.head)
+    request_data = {
+        'source_ip': exchange.client[0],
+        'destination_ip': exchange.server[0],
+        'source_port': exchange.client[1],
+        'destination_port': exchange.server[1],
+        'method': request_layer.Method.decode(),
+        'path': request_layer.Path.decode(),
+        'headers': decode_headers(request_layer.fields),
+        'timestamp': exchange.request.timestamp,
+    }
+    if exchange.request.body:
+        try:
+            request_data['body'] = exchange.request.body.decode()
+        except UnicodeDecodeError:
+            # If request body is binary, encode it as base64
+            request_data['body'] = {
+                'encoding': 'base64',
+                'data': base64.b64encode(exchange.request.body).decode('utf-8')
             }
-            tcp_streams[stream_key]["response_headers"] = response_data
 
-            if pak.haslayer(Raw):
-                tcp_streams[stream_key]["response_body"] = pak[Raw].load
+    response_layer = HTTPResponse(exchange.response.head)
+    response_data = {
+        'source_ip': exchange.server[0],
+        'destination_ip': exchange.client[0],
+        'source_port': exchange.server[1],
+        'destination_port': exchange.client[1],
+        'status_code': response_layer.Status_Code.decode(),
+        'reason_phrase': response_layer.Reason_Phrase.decode(),
+        'headers': decode_headers(response_layer.fields),
+        'timestamp': exchange.response.timestamp,
+    }
+    response_data['Content-Length'] = len(exchange.response.body)
+    response_data['body'] = exchange.response.body
+    return request_data, response_data
+
+
+def save_exchange(exchange: Exchange):
+    request_data, response_data = exchange_to_packet(exchange)
+    logger.debug("Exchange %s -> %s: request %s", exchange.client, exchange.server, truncate(request_data))
+    outcome = save_packet(request_data, response_data, exchange.frames)
+    logger.info("%s %s -> %s (%s)", request_data['method'], truncate(request_data['path'], 200),
+                response_data['status_code'], outcome)
+    if logger.isEnabledFor(logging.DEBUG):
+        stats = reassembler.stats
+        logger.debug("%d open streams, %d bytes buffered, %d incomplete, %d evicted", len(reassembler.connections),
+                     reassembler.buffered, stats['incomplete'],
+                     stats['evicted_idle'] + stats['evicted_lru'] + stats['evicted_memory'])
 
-        # Check if the TCP stream is ending (FIN flag)
-        if pak[TCP].flags.F == 1:
-            if tcp_streams[stream_key]["request"] is None or tcp_streams[stream_key]["response_headers"] is None:
-                return
-            print(f"TCP stream ended: {stream_key}")
 
-            response_body = tcp_streams[stream_key]["response_body"]
-            response_headers = tcp_streams[stream_key]["response_headers"]
-            response_headers['Content-Length'] = len(response_body)
-            response_headers['body'] = response_body
-
-            save_packet(tcp_streams[stream_key]["request"], response_headers, tcp_streams[stream_key]["packets"])
-
-            # Clear the stream data
-            del tcp_streams[stream_key]
+def packet_callback(pak: Packet):
+    if pak.haslayer(TCP) and pak.haslayer(IP):
+        tcp = pak[TCP]
+        payload = tcp[Raw].load if tcp.haslayer(Raw) else b''
+        frame = bytes(pak) if reassembler.keep_frames else None
+        reassembler.feed(float(pak.time), pak[IP].src, tcp.sport, pak[IP].dst, tcp.dport, tcp.seq, int(tcp.flags),
+                         payload, frame)
+
+
+def start_capture(port=8000, idle_timeout=120.0, memory_budget=256 * 1024 * 1024):
+    global reassembler
+    reassembler = TcpReassembler(save_exchange, server_ports={port}, keep_frames=pcap_writer.enabled,
+                                 idle_timeout=idle_timeout, memory_budget=memory_budget)
+    # Only dissect the link, IP and TCP layers, HTTP is parsed by the reassembler
+    conf.layers.filter([Ether, CookedLinux, IP, TCP])
+    # Stopping the capture process (docker stop, terminate) leaves sniff() through the finally block below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        sniff(filter=f"tcp port {port}", prn=packet_callback, store=0)
+    finally:
+        stop_capture()
 
 
-def start_capture(port=8000):
-    # Bind layers
-    bind_layers(TCP, HTTP, sport=port)
-    bind_layers(TCP, HTTP, dport=port)
-    sniff(filter=f"tcp port {port}", prn=packet_callback, store=0)
+def stop_capture():
+    """
+    Write what the capture still holds. The capture process leaves with os._exit, its exit hooks never run.
+    """
+    # Responses delimited by the end of their connection are complete once the capture stops
+    try:
+        reassembler.flush()
+    finally:
+        pcap_writer.close()
+        if recording_writer is not None:
+            recording_writer.close()
+        if layer_writer is not None:
+            # Writes the summary of the layer, or removes it if nothing was captured
+            layer_writer.close()
 
 
-def run_http(app_name: str):
+def run_http(app_name: str, recapture=False):
+    """
+    Capture the HTTP traffic of an app. An app that already has a recording is only captured again with recapture,
+    into a delta layer holding the exchanges that changed.
+    """
+    setup_logging()
     resources_dir = os.path.join(os.getcwd(), 'resources/http')
     global apk_name
     apk_name = app_name
@@ -188,7 +214,17 @@ def run_http(app_name: str):
     app_path = resources_dir + '/' + app_name
     global path
     path = app_path
+    global pcap_writer
     if not os.path.exists(app_path):
         os.makedirs(app_path)
-        print('HTTP initial capture started')
+        pcap_writer = PcapStreamWriter(os.path.join(app_path, 'http.pcap'))
+        logger.info("HTTP initial capture started, saving packets to %s", app_path)
         start_capture()
+    elif recapture:
+        global layer_writer
+        layer_writer = LayerWriter(app_path, app_name)
+        pcap_writer = PcapStreamWriter(os.path.join(layer_writer.layer_path, 'http.pcap'))
+        logger.info("HTTP re-capture started, saving the changes to %s", layer_writer.layer_path)
+        start_capture()
+    else:
+        logger.info("%s already has a recording, not capturing (re-capture it with --recapture)", app_name)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+
+from proto.http.server import METRICS_PATH, READY_PATH, PacketMatcher, build_request_frame, build_response_frame
+from services.metrics import format_prometheus
+
+# Maximum size of a request head
+MAX_HEAD_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def parse_latency(latency):
+    """
+    Parse a latency option into the factor applied to the recorded response times.
+    :param latency: 'off' (no delay), 'real' (recorded delay) or a scale factor such as '0.5'
+    """
+    if latency in (None, '', 'off'):
+        return 0.0
+    if latency == 'real':
+        return 1.0
+    scale = float(latency)
+    if scale < 0:
+        raise ValueError("The latency scale can not be negative")
+    return scale
+
+
+def text_response(body, content_type, status=200, keep_alive=True):
+    head = (f'HTTP/1.1 {status} {"OK" if status == 200 else "Not Found"}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    return head.encode() + body
+
+
+def json_response(data, status=200, keep_alive=True):
+    return text_response(json.dumps(data).encode() + b'\n', 'application/json', status, keep_alive)
+
+
+def error_response(message, status=404, keep_alive=True):
+    return json_response({"error": message}, status, keep_alive)
+
+
+async def read_chunked_body(reader):
+    body = bytearray()
+    while True:
+        size_line = await reader.readuntil(b'\r\n')
+        size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+        if size == 0:
+            # Skip the trailers
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+            return bytes(body)
+        body += await reader.readexactly(size)
+        await reader.readexactly(2)
+
+
+class AsyncReplayServer:
+    """
+    asyncio frontend for a PacketMatcher.
+
+    Requests are served concurrently, matching happens on the event loop and every disk write (report, diff files,
+    pcap frames) runs in order on a background worker. Recorded response times can be replayed, scaled or skipped.
+    """
+
+    def __init__(self, packet_matcher: PacketMatcher, host='0.0.0.0', port=80, latency_scale=0.0):
+        self.packet_matcher = packet_matcher
+        self.host = host
+        self.port = port
+        self.latency_scale = latency_scale
+        self.persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='replay-persist')
+        self.pending = set()
+        self.connections = set()
+        self.shutdown_event = None
+
+    def persist(self, fn):
+        """
+        Schedule a disk write on the background worker, writes run in the order they were scheduled.
+        """
+        future = asyncio.get_running_loop().run_in_executor(self.persist_executor, fn)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+
+    async def read_request(self, reader, writer):
+        """
+        Read one HTTP/1.1 request from a connection.
+        :return: An (incoming_request, keep_alive) tuple, or None when the connection is closed
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            # Same header names as Flask's request.headers
+            headers[name.strip().replace('_', '-').title()] = value.strip()
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = await read_chunked_body(reader)
+        else:
+            body = await reader.readexactly(int(headers.get('Content-Length') or 0))
+
+        connection = headers.get('Connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername') or ('', 0)
+        sock = writer.get_extra_info('sockname') or ('', self.port)
+        incoming_request = {
+            'source_ip': peer[0],
+            'destination_ip': headers.get('Host', sock[0]),
+            'source_port': str(peer[1]),
+            'destination_port': str(sock[1]),
+            'method': method,
+            'path': unquote(path),
+            'headers': headers
+        }
+        if query:
+            incoming_request['query'] = query
+        if body:
+            incoming_request['body'] = body.decode(errors='replace')
+        return incoming_request, keep_alive
+
+    async def handle_request(self, incoming_request, keep_alive):
+        matcher = self.packet_matcher
+        if incoming_request['path'] == READY_PATH:
+            ready = {"ready": True, "packets": len(matcher.index.packets), "remaining": len(matcher.index)}
+            return (json_response(ready, keep_alive=keep_alive),), keep_alive
+        metrics = matcher.metrics
+        if incoming_request['path'] == METRICS_PATH:
+            snapshots = [({'app': matcher.apk_name}, metrics.snapshot())]
+            if parse_qs(incoming_request.get('query', '')).get('format') == ['json']:
+                data = [{'labels': labels, **snapshot} for labels, snapshot in snapshots]
+                return (json_response(data, keep_alive=keep_alive),), keep_alive
+            body = format_prometheus(snapshots).encode()
+            return (text_response(body, 'text/plain; version=0.0.4', keep_alive=keep_alive),), keep_alive
+        with metrics.profiling():
+            response, persist = matcher.match_packets(incoming_request)
+        pcap = matcher.pcap
+
+        def write_outcome():
+            with metrics.span('persist'):
+                persist()
+            with metrics.span('pcap'):
+                if pcap.enabled:
+                    pcap.write(build_request_frame(incoming_request, pcap.raw))
+                    if response not in (None, -1):
+                        pcap.write(build_response_frame(response.data, response.body, pcap.raw))
+
+        self.persist(write_outcome)
+
+        if response == -1:
+            self.shutdown_event.set()
+            return (error_response("All requests compared", keep_alive=False),), False
+        if response is None:
+            return (error_response("No matching packet found", keep_alive=keep_alive),), keep_alive
+
+        if self.latency_scale and response.latency:
+            await asyncio.sleep(response.latency * self.latency_scale)
+        # The body can be a memoryview of the blob file, it is handed to the transport without a copy
+        return (response.to_http_head(keep_alive), response.body), keep_alive
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self.read_request(reader, writer)
+                if request is None:
+                    break
+                chunks, keep_alive = await self.handle_request(*request)
+                writer.writelines(chunks)
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        self.shutdown_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_HEAD_SIZE)
+        logger.info("Serving in async mode on %s:%s", self.host, self.port)
+        async with server:
+            await self.shutdown_event.wait()
+            # Drain: stop accepting, close the idle connections and wait for the pending writes
+            server.close()
+            for writer in list(self.connections):
+                writer.close()
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        self.persist_executor.shutdown(wait=True)
+        self.packet_matcher.close()
+
+
+def run_async_server(packet_directory, app_name, host='0.0.0.0', port=80, latency='off', run_id=None):
+    packet_matcher = PacketMatcher(packet_directory, app_name, run_id=run_id)
+    server = AsyncReplayServer(packet_matcher, host, port, parse_latency(latency))
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        packet_matcher.close()
@@ -0,0 +1,347 @@
+import base64
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from proto.http.request_service import decode_body
+from proto.http.server import READY_PATH, create_app, run_server
+from services.blob_store import BLOB_FILE
+from services.recording_store import (INDEX_SUFFIX, KEYS_SUFFIX, RecordingWriter, iter_recording,
+                                      recording_file_name, recording_path)
+
+BENCH_MODES = ('in-process', 'loopback', 'both')
+# Schema of synthesized recordings: requests are compared on method and body, the path is matched by the index
+BENCH_SCHEMA = {'request': {'method': True, 'body': True}, 'response': True}
+
+logger = logging.getLogger(__name__)
+
+
+def synthesize_recording(directory, exchanges=1000, body_size=2048, binary_ratio=0.1, cookies=5, seed=0):
+    """
+    Write a recording of synthetic exchanges: JSON and binary responses of about body_size bytes,
+    requests and responses carrying the given number of cookies.
+    """
+    rng = random.Random(seed)
+    writer = RecordingWriter(os.path.join(directory, recording_file_name()), fsync_interval=float('inf'),
+                             fsync_every=exchanges + 1, blobs=True)
+    start = time.time() - exchanges * 0.05
+    for i in range(exchanges):
+        request_time = start + i * 0.05
+        method = 'POST' if i % 4 == 0 else 'GET'
+        request_headers = {
+            'Host': 'bench.local',
+            'User_Agent': 'shift-bench/1.0',
+            'Accept': '*/*',
+            'Cookie': '; '.join(f'session{k}={rng.getrandbits(64):016x}' for k in range(cookies)),
+        }
+        request_data = {
+            'source_ip': '10.0.2.16',
+            'destination_ip': '10.0.2.2',
+            'source_port': 40000 + i % 20000,
+            'destination_port': 80,
+            'method': method,
+            'path': f'/api/v1/items/{i % 97}?page={i}',
+            'headers': request_headers,
+            'timestamp': request_time,
+        }
+        if method == 'POST':
+            request_data['body'] = json.dumps({'item': i, 'query': 'x' * 32})
+
+        if rng.random() < binary_ratio:
+            content_type = 'image/png'
+            body = {'encoding': 'base64', 'data': base64.b64encode(rng.randbytes(body_size)).decode()}
+        else:
+            content_type = 'application/json'
+            items = [{'id': k, 'name': f'item-{k}'} for k in range(max(1, body_size // 28))]
+            body = {'encoding': 'utf-8', 'data': json.dumps({'items': items})}
+        response_headers = {
+            'Content_Type': content_type,
+            'Cache_Control': 'no-cache',
+            'Set_Cookie': '§ '.join(f'session{k}={rng.getrandbits(64):016x}; Path=/; HttpOnly'
+                                    for k in range(cookies)),
+        }
+        writer.append({
+            'request': request_data,
+            'response': {
+                'source_ip': '10.0.2.2',
+                'destination_ip': '10.0.2.16',
+                'source_port': 80,
+                'destination_port': request_data['source_port'],
+                'status_code': '200',
+                'reason_phrase': 'OK',
+                'headers': response_headers,
+                'timestamp': request_time + 0.002 + rng.random() * 0.02,
+                'body': body,
+            }
+        })
+    writer.close()
+
+
+def prepare_workdir(workdir, app_name, synthesize, **synthesize_options):
+    """
+    Lay out a working directory for the benchmark, with the recording of the app (linked, or synthesized) and its
+    schema, so reports and diff files are not written in the project.
+    :return: The recording directory and whether the recording was synthesized
+    """
+    packet_directory = os.path.join(workdir, 'resources/http', app_name)
+    os.makedirs(packet_directory, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'schema'), exist_ok=True)
+    source_directory = os.path.join('resources/http', app_name)
+    source_path = recording_path(source_directory)
+
+    synthesize = synthesize or source_path is None
+    if synthesize:
+        synthesize_recording(packet_directory, **synthesize_options)
+        schema = BENCH_SCHEMA
+    else:
+        for file_path in (source_path, source_path + INDEX_SUFFIX, source_path + KEYS_SUFFIX,
+                          os.path.join(source_directory, BLOB_FILE)):
+            if os.path.isfile(file_path):
+                os.symlink(os.path.abspath(file_path), os.path.join(packet_directory, os.path.basename(file_path)))
+        schema = None
+        if os.path.isfile(os.path.join('schema', app_name + '.json')):
+            shutil.copy(os.path.join('schema', app_name + '.json'), os.path.join(workdir, 'schema'))
+    if schema is not None:
+        with open(os.path.join(workdir, 'schema', app_name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(schema, f)
+    return packet_directory, synthesize
+
+
+def load_requests(packet_directory):
+    """
+    Build the requests to replay from the recording, with the header names an HTTP client sends.
+    """
+    requests = []
+    for packet in iter_recording(packet_directory):
+        request_data = packet['request']
+        headers = {name.replace('_', '-'): value for name, value in request_data.get('headers', {}).items()
+                   if isinstance(value, str)}
+        body = decode_body(request_data.get('body')) or b''
+        requests.append((request_data['method'], request_data['path'], headers, bytes(body)))
+    return requests
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    def at(q):
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+    return {'p50_ms': at(0.50), 'p95_ms': at(0.95), 'p99_ms': at(0.99), 'max_ms': round(latencies[-1] * 1000, 3)}
+
+
+def _run_clients(requests, concurrency, send):
+    """
+    Replay the requests from concurrent clients, every client sending every concurrency-th request.
+    :param send: Callable (client number, request) returning the status code, called from the client threads
+    :return: The per-request latencies, the number of non-200 responses and the elapsed seconds
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(number):
+        local = []
+        local_errors = 0
+        for request in requests[number::concurrency]:
+            started = time.perf_counter()
+            status = send(number, request)
+            local.append(time.perf_counter() - started)
+            if status != 200:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def _summary(latencies, errors, elapsed, startup):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 4),
+        'requests_per_s': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'startup_s': round(startup, 4),
+        **percentiles(latencies),
+    }
+
+
+def bench_in_process(app_name, requests, concurrency=8, run_id=None):
+    """
+    Replay through the Flask app in this process (WSGI stack, matching, report and pcap writers, no sockets).
+    """
+    started = time.perf_counter()
+    app = create_app(os.path.join('resources/http', app_name), app_name, serve_mode='threaded', run_id=run_id)
+    startup = time.perf_counter() - started
+    clients = []
+    for number in range(concurrency):
+        client = app.test_client()
+        # The test client has no socket, every client gets the port a real connection would have
+        client.environ_base['REMOTE_PORT'] = str(40000 + number)
+        clients.append(client)
+
+    def send(number, request):
+        method, path, headers, body = request
+        response = clients[number].open(path, method=method, headers=headers, data=body)
+        response.get_data()
+        return response.status_code
+
+    latencies, errors, elapsed = _run_clients(requests, concurrency, send)
+    app.config['REPLAY_BACKEND'].close()
+    result = _summary(latencies, errors, elapsed, startup)
+    # Peak RSS of this process, harness included (ru_maxrss is in KiB on Linux)
+    result['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _peak_rss_kib(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _wait_ready(port, process, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.is_alive():
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1.0)
+            connection.request('GET', READY_PATH)
+            if connection.getresponse().status == 200:
+                connection.close()
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def bench_loopback(app_name, requests, concurrency=8, serve_mode='threaded', threads=8, run_id=None):
+    """
+    Replay over loopback against a server process, with one keep-alive connection per client.
+    """
+    port = _free_port()
+    started = time.perf_counter()
+    process = multiprocessing.Process(target=run_server, args=(app_name,),
+                                      kwargs={'host': '127.0.0.1', 'port': port, 'serve_mode': serve_mode,
+                                              'threads': threads, 'run_id': run_id})
+    process.start()
+    if not _wait_ready(port, process):
+        process.terminate()
+        raise RuntimeError(f"The replay server did not start in {serve_mode} mode")
+    startup = time.perf_counter() - started
+
+    connections = [http.client.HTTPConnection('127.0.0.1', port, timeout=30.0) for _ in range(concurrency)]
+
+    def send(number, request):
+        method, path, headers, body = request
+        connection = connections[number]
+        connection.request(method, path, body=body or None, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    latencies, errors, elapsed = _run_clients(requests, concurrency, send)
+    for connection in connections:
+        connection.close()
+    peak_rss = _peak_rss_kib(process.pid)
+
+    # One more request ends the session, the server then drains and exits
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5.0)
+        connection.request('GET', '/__shift/end')
+        connection.getresponse().read()
+    except OSError:
+        pass
+    process.join(30.0)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+    result = _summary(latencies, errors, elapsed, startup)
+    result['peak_rss_kib'] = peak_rss
+    result['serve_mode'] = serve_mode
+    return result
+
+
+def run_bench(app_name, exchanges=1000, body_size=2048, binary_ratio=0.1, cookies=5, concurrency=8,
+              mode='both', serve_mode='threaded', threads=8, synthesize=False, output='bench_results.json',
+              workdir=None):
+    """
+    Benchmark the replay server on a recording and write the results to a JSON file.
+    The recording of the app is used when it exists, unless synthesize is set.
+    :return: The results, or None if requests failed, in which case no results are written
+    """
+    if mode not in BENCH_MODES:
+        raise ValueError(f"Unknown bench mode {mode}, expected one of {', '.join(BENCH_MODES)}")
+    output = os.path.abspath(output)
+    project_dir = os.getcwd()
+    keep_workdir = workdir is not None
+    workdir = os.path.abspath(workdir) if workdir else tempfile.mkdtemp(prefix='shift-bench-')
+
+    packet_directory, synthesized = prepare_workdir(workdir, app_name, synthesize, exchanges=exchanges,
+                                                    body_size=body_size, binary_ratio=binary_ratio, cookies=cookies)
+    os.chdir(workdir)
+    try:
+        requests = load_requests(packet_directory)
+        results = {
+            'app': app_name,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'config': {'exchanges': len(requests), 'body_size': body_size, 'binary_ratio': binary_ratio,
+                       'cookies': cookies, 'concurrency': concurrency, 'synthesized': synthesized},
+            'runs': {},
+        }
+        # Every run reports in its own directory
+        run_id = str(int(time.time()))
+        if mode in ('in-process', 'both'):
+            results['runs']['in_process'] = bench_in_process(app_name, requests, concurrency,
+                                                             run_id=f'{run_id}-in-process')
+            logger.info("in-process: %s", json.dumps(results['runs']['in_process']))
+        if mode in ('loopback', 'both'):
+            results['runs']['loopback'] = bench_loopback(app_name, requests, concurrency, serve_mode, threads,
+                                                         run_id=f'{run_id}-loopback')
+            logger.info("loopback: %s", json.dumps(results['runs']['loopback']))
+    finally:
+        os.chdir(project_dir)
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    failed = {name: run['errors'] for name, run in results['runs'].items() if run['errors']}
+    if failed:
+        logger.error("Requests failed (%s), the results are not saved",
+                     ', '.join(f'{name}: {errors}/{len(requests)}' for name, errors in failed.items()))
+        return None
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    logger.info("Benchmark results saved to %s", output)
+    return results
@@ -1,53 +1,104 @@
-from services.schema_filter import filter_data_by_schema
+from proto.http.request_service import freeze_headers
+from services.dict_utils import fingerprint, flatten
+from services.schema_filter import SchemaProjector
 
 
 class HttpRequestPacket:
+    """
+    Request of an exchange. Headers are kept as an immutable tuple of pairs, the dict view, the schema projection
+    and its fingerprint are computed on first use and cached until the body or the schema changes.
+    """
+
+    __slots__ = ('source_ip', 'destination_ip', 'source_port', 'destination_port', 'method', 'path', 'headers',
+                 'body', 'schema', 'projector', 'view', 'filtered', 'digest', 'leaves')
+
     def __init__(self, source_ip, destination_ip, source_port, destination_port, method, path, headers):
         self.body = None
         self.schema = None
+        self.projector = None
+        self.view = None
+        self.filtered = None
+        self.digest = None
+        self.leaves = None
         self.source_ip = source_ip
         self.destination_ip = destination_ip
         self.source_port = source_port
         self.destination_port = destination_port
         self.method = method
         self.path = path
-        self.headers = headers
+        self.headers = freeze_headers(headers)
 
     def add_body(self, body):
         self.body = body
+        self.view = None
+        self.filtered = None
+        self.digest = None
+        self.leaves = None
 
     def add_schema(self, schema):
-        self.schema = schema
+        """
+        :param schema: Schema dictionary or an already compiled SchemaProjector
+        """
+        if not isinstance(schema, SchemaProjector):
+            schema = SchemaProjector(schema)
+        self.projector = schema
+        self.schema = schema.schema
+        self.filtered = None
+        self.digest = None
+        self.leaves = None
 
     def to_dict(self):
-        return {
-            'source_ip': self.source_ip,
-            'destination_ip': self.destination_ip,
-            'source_port': self.source_port,
-            'destination_port': self.destination_port,
-            'method': self.method,
-            'path': self.path,
-            'headers': self.headers,
-            'body': self.body
-        }
+        """
+        Return the dict view of the packet, built once. It is shared, callers must not change it.
+        """
+        if self.view is None:
+            self.view = {
+                'source_ip': self.source_ip,
+                'destination_ip': self.destination_ip,
+                'source_port': self.source_port,
+                'destination_port': self.destination_port,
+                'method': self.method,
+                'path': self.path,
+                'headers': dict(self.headers),
+                'body': self.body
+            }
+        return self.view
 
     def to_filtered_dict(self):
-        return filter_data_by_schema(self.to_dict(), self.schema)
+        """
+        Return the schema-projected dict of the packet, computed once and reused for equality, diffing and reports.
+        """
+        if self.filtered is None:
+            if not self.schema:
+                self.filtered = self.to_dict()
+            else:
+                self.filtered = self.projector.project(self.to_dict())
+        return self.filtered
+
+    def fingerprint(self):
+        """
+        Return the content hash of the schema-projected packet, computed once.
+        """
+        if self.digest is None:
+            self.digest = fingerprint(self.to_filtered_dict())
+        return self.digest
+
+    def flattened(self):
+        """
+        Return the {path: value} leaves of the schema-projected packet, computed once for similarity scoring.
+        """
+        if self.leaves is None:
+            self.leaves = flatten(self.to_filtered_dict())
+        return self.leaves
 
     def __eq__(self, other):
         """
-        Compare two HttpPacket objects.
+        Compare two HttpPacket objects by the fingerprint of their schema-projected content.
         :param other: The other HttpPacket object
-        :param schema: Optional schema to filter the comparison
         :return: True if the objects are equal, False otherwise
         """
+        if other.projector is self.projector:
+            return self.fingerprint() == other.fingerprint()
 
-        if not self.schema:
-            return self.to_dict() == other.to_dict()
-
-        self_filtered = filter_data_by_schema(self.to_dict(), self.schema)
-        other_filtered = filter_data_by_schema(other.to_dict(), self.schema)
-
-        print('Comparing : ', self_filtered, other_filtered)
-
-        return self_filtered == other_filtered
\ No newline at end of file
+        other_filtered = self.projector.project(other.to_dict()) if self.schema else other.to_dict()
+        return self.fingerprint() == fingerprint(other_filtered)
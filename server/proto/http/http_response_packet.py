@@ -1,31 +1,52 @@
+from proto.http.request_service import freeze_headers
 from services.schema_filter import filter_data_by_schema
 
 
 class HttpResponsePacket:
+    """
+    Response of an exchange, with its headers kept as an immutable tuple of pairs.
+    """
+
+    __slots__ = ('source_ip', 'destination_ip', 'source_port', 'destination_port', 'status_code', 'reason_phrase',
+                 'headers', 'body', 'view')
+
     def __init__(self, source_ip, destination_ip, source_port, destination_port, status_code, reason_phrase, headers):
         self.body = None
+        self.view = None
         self.source_ip = source_ip
         self.destination_ip = destination_ip
         self.source_port = source_port
         self.destination_port = destination_port
         self.status_code = status_code
         self.reason_phrase = reason_phrase
-        self.headers = headers
+        self.headers = freeze_headers(headers)
 
     def add_body(self, body):
         self.body = body
+        self.view = None
+
+    def get_header(self, name, default=None):
+        for header, value in self.headers:
+            if header == name:
+                return value
+        return default
 
     def to_dict(self):
-        return {
-            'source_ip': self.source_ip,
-            'destination_ip': self.destination_ip,
-            'source_port': self.source_port,
-            'destination_port': self.destination_port,
-            'status_code': self.status_code,
-            'reason_phrase': self.reason_phrase,
-            'headers': self.headers,
-            'body': self.body
-        }
+        """
+        Return the dict view of the packet, built once. It is shared, callers must not change it.
+        """
+        if self.view is None:
+            self.view = {
+                'source_ip': self.source_ip,
+                'destination_ip': self.destination_ip,
+                'source_port': self.source_port,
+                'destination_port': self.destination_port,
+                'status_code': self.status_code,
+                'reason_phrase': self.reason_phrase,
+                'headers': dict(self.headers),
+                'body': self.body
+            }
+        return self.view
 
     def __eq__(self, other, schema=None):
         """
@@ -40,4 +61,4 @@ class HttpResponsePacket:
         self_filtered = filter_data_by_schema(self.to_dict(), schema)
         other_filtered = filter_data_by_schema(other.to_dict(), schema)
 
-        return self_filtered == other_filtered
\ No newline at end of file
+        return self_filtered == other_filtered
@@ -0,0 +1,168 @@
+import os
+import re
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl
+
+MATCH_MODES = ('exact', 'fuzzy')
+DEFAULT_MATCH_MODE = os.getenv('SHIFT_MATCH_MODE', 'exact')
+# Number of unconsumed candidates scored for a request in fuzzy mode
+DEFAULT_MATCH_WINDOW = int(os.getenv('SHIFT_MATCH_WINDOW', '32'))
+
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{16,})$')
+_DIGIT = re.compile(r'\d')
+
+
+def normalize_path(path):
+    """
+    Normalize a request path for lookup: the query string is dropped (Flask's request.path never carries it while
+    recorded scapy paths do) and trailing slashes are ignored.
+    """
+    path = path.split('?', 1)[0]
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+    return path
+
+
+def packet_key(request_data):
+    return request_data['method'], normalize_path(request_data['path'])
+
+
+def _is_variable_segment(segment):
+    return bool(_ID_SEGMENT.match(segment)) or (len(segment) >= 20 and bool(_DIGIT.search(segment)))
+
+
+def route_template(path):
+    """
+    Route of a path with its identifier segments (numbers, UUIDs, hashes, tokens) replaced by '{}'.
+    """
+    return '/'.join('{}' if _is_variable_segment(segment) else segment
+                    for segment in normalize_path(path).split('/'))
+
+
+def query_keys(request_data):
+    """
+    Set of the query parameter names of a request, read from its 'query' field or from the query string of its path.
+    """
+    query = request_data.get('query')
+    if query is None:
+        query = request_data['path'].partition('?')[2]
+    return frozenset(key for key, _ in parse_qsl(query, keep_blank_values=True))
+
+
+class PacketIndex:
+    """
+    Index of recorded packets keyed by (method, normalized path).
+    Each key holds a FIFO queue of packet positions so the first unconsumed match wins, as with a linear scan.
+    """
+
+    def __init__(self, packets=()):
+        self.packets = []
+        self.consumed = bytearray()
+        self.queues = defaultdict(deque)
+        self.remaining_count = 0
+        for packet in packets:
+            self.add(packet)
+
+    def add(self, packet):
+        position = len(self.packets)
+        self.packets.append(packet)
+        self.consumed.append(0)
+        self.queues[packet_key(packet['request'])].append(position)
+        self.remaining_count += 1
+        return position
+
+    def take(self, method, path):
+        """
+        Consume the first unconsumed packet matching method and path.
+        :return: The position of the packet, or None if there is no match
+        """
+        queue = self.queues.get((method, normalize_path(path)))
+        if not queue:
+            return None
+        position = queue.popleft()
+        self.consumed[position] = 1
+        self.remaining_count -= 1
+        return position
+
+    def remaining(self):
+        """
+        Iterate over the positions of the packets that were never consumed, in recording order.
+        """
+        if not self.remaining_count:
+            return
+        for position in range(len(self.packets)):
+            if not self.consumed[position]:
+                yield position
+
+    def __len__(self):
+        return self.remaining_count
+
+
+class FuzzyPacketIndex(PacketIndex):
+    """
+    Index of recorded packets for out-of-order matching.
+
+    Candidates are looked up by (method, route template, query keys), falling back to (method, route template), and
+    only the first window unconsumed candidates of a bucket are scored, so a lookup never scans the whole recording.
+    """
+
+    def __init__(self, packets=(), window=None):
+        self.window = window or DEFAULT_MATCH_WINDOW
+        self.routes = defaultdict(deque)
+        self.templates = defaultdict(deque)
+        super().__init__(packets)
+
+    def add(self, packet):
+        position = super().add(packet)
+        request_data = packet['request']
+        route = request_data['method'], route_template(request_data['path'])
+        self.templates[route].append(position)
+        self.routes[route + (query_keys(request_data),)].append(position)
+        return position
+
+    def _candidates(self, bucket):
+        """
+        Return the first window unconsumed positions of a bucket. Consumed positions are dropped lazily.
+        """
+        while bucket and self.consumed[bucket[0]]:
+            bucket.popleft()
+        candidates = []
+        stale = 0
+        for position in bucket:
+            if self.consumed[position]:
+                stale += 1
+                continue
+            candidates.append(position)
+            if len(candidates) >= self.window:
+                break
+        if stale > self.window:
+            live = [position for position in bucket if not self.consumed[position]]
+            bucket.clear()
+            bucket.extend(live)
+        return candidates
+
+    def take_best(self, request_data, score):
+        """
+        Consume the best scored candidate for a request. Ties go to the exact path, then to the earliest packet.
+        :param score: Callable returning the similarity (0 to 1) of the packet at a position with the request
+        :return: The position of the packet, or None if no candidate shares the route of the request
+        """
+        route = request_data['method'], route_template(request_data['path'])
+        candidates = self._candidates(self.routes.get(route + (query_keys(request_data),), deque()))
+        if not candidates:
+            candidates = self._candidates(self.templates.get(route, deque()))
+        if not candidates:
+            return None
+
+        path = normalize_path(request_data['path'])
+        best_rank = best_position = None
+        for position in candidates:
+            rank = score(position), normalize_path(self.packets[position]['request']['path']) == path
+            if best_rank is None or rank > best_rank:
+                best_rank, best_position = rank, position
+                if rank == (1.0, True):
+                    break
+
+        self.consumed[best_position] = 1
+        self.remaining_count -= 1
+        return best_position
@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import zlib
+
+from proto.http.app import exchange_to_packet, packet_record
+from proto.http.tcp_reassembly import TcpReassembler, parse_frame
+from services.pcap_reader import iter_capture_file
+from services.recording_store import KEYS_SUFFIX, RECORDING_FILE, RecordingWriter, recording_file_name, recording_path
+
+# Seconds of capture time an exchange is held back so the shard stays ordered by request time
+REORDER_WINDOW = 120.0
+
+logger = logging.getLogger(__name__)
+
+
+def flow_hash(src, sport, dst, dport):
+    """
+    Hash of a TCP flow, identical for both directions.
+    """
+    low, high = sorted(((src, sport), (dst, dport)))
+    return zlib.crc32(f'{low[0]}:{low[1]}-{high[0]}:{high[1]}'.encode())
+
+
+def _request_time(record):
+    return record['request'].get('timestamp') or 0.0
+
+
+def import_shard(file_paths, output_path, shard=0, shards=1, port=None):
+    """
+    Extract the exchanges of the flows of one shard and write them ordered by request time.
+    :return: The number of exchanges written
+    """
+    # Shards are deduplicated and moved to the blob file once merged, references are positions in the final files
+    writer = RecordingWriter(output_path, dedupe=shards == 1, blobs=shards == 1)
+    pending = []
+    counter = itertools.count()
+    written = 0
+
+    def on_exchange(exchange):
+        record = packet_record(*exchange_to_packet(exchange))
+        heapq.heappush(pending, (_request_time(record), next(counter), record))
+
+    reassembler = TcpReassembler(on_exchange, server_ports={port} if port else None, keep_frames=False)
+    for file_path in file_paths:
+        for timestamp, linktype, frame in iter_capture_file(file_path):
+            segment = parse_frame(frame, linktype)
+            if segment is None:
+                continue
+            src, sport, dst, dport, seq, flags, payload = segment
+            if shards > 1 and flow_hash(src, sport, dst, dport) % shards != shard:
+                continue
+            reassembler.feed(timestamp, src, sport, dst, dport, seq, flags, payload)
+            while pending and pending[0][0] < timestamp - REORDER_WINDOW:
+                writer.append(heapq.heappop(pending)[2])
+                written += 1
+    reassembler.flush()
+    while pending:
+        writer.append(heapq.heappop(pending)[2])
+        written += 1
+    writer.close()
+    return written
+
+
+def _import_shard(args):
+    return import_shard(*args)
+
+
+def _iter_records(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def import_pcap(app_name, file_paths, workers=1, port=None):
+    """
+    Build the recording of an app from existing pcap/pcapng files.
+
+    Files are streamed frame by frame through the same reassembly as the live capture. With several workers, every
+    worker handles the flows of its own hash shard and the shards are merged by request time.
+    """
+    app_path = os.path.join(os.getcwd(), 'resources/http', app_name)
+    if recording_path(app_path) is not None:
+        raise FileExistsError(f"A recording already exists in {app_path}")
+    os.makedirs(app_path, exist_ok=True)
+    output_path = os.path.join(app_path, recording_file_name())
+
+    if workers <= 1:
+        count = import_shard(file_paths, output_path, port=port)
+        logger.info("Imported %d exchanges into %s", count, output_path)
+        return count
+
+    shard_paths = [os.path.join(app_path, f'{RECORDING_FILE}.shard{shard}') for shard in range(workers)]
+    with multiprocessing.Pool(workers) as pool:
+        counts = pool.map(_import_shard, [(file_paths, shard_paths[shard], shard, workers, port)
+                                          for shard in range(workers)])
+
+    writer = RecordingWriter(output_path, dedupe=True, blobs=True)
+    for record in heapq.merge(*(_iter_records(shard_path) for shard_path in shard_paths), key=_request_time):
+        writer.append(record)
+    writer.close()
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+        os.remove(shard_path + KEYS_SUFFIX)
+    logger.info("Imported %d exchanges into %s with %d workers", sum(counts), output_path, workers)
+    return sum(counts)
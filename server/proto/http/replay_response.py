@@ -0,0 +1,133 @@
+from datetime import datetime
+from http import HTTPStatus
+
+from flask import Response
+from werkzeug.datastructures import Headers
+from werkzeug.http import dump_cookie
+
+from proto.http.http_response_packet import HttpResponsePacket
+from proto.http.request_service import decode_body
+
+# Recorded headers that must not be replayed as is, the server computes them again
+SKIPPED_HEADERS = ("Transfer_Encoding", "Content_Encoding", "Content_Length")
+
+
+def parse_set_cookie(value):
+    """
+    Parse the recorded Set-Cookie header (cookies are joined with '§') into rendered Set-Cookie header values.
+    """
+    cookies = []
+    for cookie in value.split('§'):
+        cookie = cookie.strip()
+        if not cookie:
+            continue
+
+        parts = cookie.split('=', 1)
+        if len(parts) != 2:
+            continue
+
+        cookie_name, rest = parts
+        cookie_parts = rest.split(';')
+        cookie_value = cookie_parts[0]
+
+        kwargs = {}
+        for part in cookie_parts[1:]:
+            part = part.strip()
+            if '=' in part:
+                k, v = part.split('=', 1)
+                k = k.lower()
+                if k == 'expires':
+                    try:
+                        kwargs['expires'] = datetime.strptime(v, '%a, %d %b %Y %H:%M:%S %Z')
+                    except ValueError:
+                        continue
+                elif k == 'max-age':
+                    try:
+                        kwargs['max_age'] = int(v)
+                    except ValueError:
+                        continue
+                elif k == 'samesite':
+                    kwargs['samesite'] = v
+            elif part.lower() == 'httponly':
+                kwargs['httponly'] = True
+
+        cookies.append(dump_cookie(cookie_name, cookie_value, path='/', **kwargs))
+    return cookies
+
+
+class ReplayResponse:
+    """
+    Recorded response compiled into a ready-to-send form the first time its exchange is matched, then reused:
+    decoded body bytes, final header list (with rendered cookies) and status code.
+    """
+
+    def __init__(self, packet: HttpResponsePacket, latency=0.0, blobs=None):
+        """
+        :param packet: The recorded response
+        :param latency: Seconds between the recorded request and its response
+        :param blobs: BlobStore of the recording, bodies stored in it are kept as memoryview slices of the file
+        """
+        self.data = packet.to_dict()
+        self.latency = latency
+        self.raw_head = None
+        self.body = decode_body(packet.body, blobs) or b''
+        self.content_type = packet.get_header('Content_Type', 'text/plain')
+        self.binary = self.content_type.startswith('image/') or 'octet-stream' in self.content_type
+
+        headers = Headers()
+        headers['Content-Type'] = self.content_type
+        if self.binary:
+            # Binary content (images, etc.) is sent as a plain file
+            self.status_code = 200
+        else:
+            self.status_code = int(packet.status_code)
+            for header, value in packet.headers:
+                if header in SKIPPED_HEADERS:
+                    continue
+                elif header == "Unknown_Headers":
+                    for h, v in value.items():
+                        headers[h.replace('_', '-')] = str(v)
+                elif header in ['Set-Cookie', 'Set_Cookie']:
+                    for cookie in parse_set_cookie(value):
+                        headers.add('Set-Cookie', cookie)
+                else:
+                    headers[header.replace('_', '-')] = str(value)
+        self.headers = headers.to_wsgi_list()
+
+    @classmethod
+    def from_dict(cls, response_data, request_time=None, blobs=None):
+        packet = HttpResponsePacket(
+            source_ip=response_data['source_ip'],
+            destination_ip=response_data['destination_ip'],
+            source_port=response_data['source_port'],
+            destination_port=response_data['destination_port'],
+            status_code=response_data['status_code'],
+            reason_phrase=response_data['reason_phrase'],
+            headers=response_data['headers']
+        )
+        packet.add_body(response_data.get('body', ''))
+        latency = 0.0
+        if request_time is not None and response_data.get('timestamp') is not None:
+            latency = max(0.0, response_data['timestamp'] - request_time)
+        return cls(packet, latency, blobs)
+
+    def to_flask_response(self):
+        # WSGI servers only accept bytes, memory-mapped bodies are copied here
+        body = self.body if isinstance(self.body, bytes) else bytes(self.body)
+        return Response(body, status=self.status_code, headers=self.headers)
+
+    def to_http_head(self, keep_alive=True):
+        """
+        Return the raw HTTP/1.1 status line and headers, built on first use and then reused.
+        """
+        if self.raw_head is None:
+            try:
+                reason = HTTPStatus(self.status_code).phrase
+            except ValueError:
+                reason = self.data.get('reason_phrase', '')
+            lines = [f'HTTP/1.1 {self.status_code} {reason}']
+            lines.extend(f'{name}: {value}' for name, value in self.headers)
+            lines.append(f'Content-Length: {len(self.body)}')
+            self.raw_head = ('\r\n'.join(lines) + '\r\n').encode('latin-1', errors='replace')
+        connection = b'Connection: keep-alive\r\n\r\n' if keep_alive else b'Connection: close\r\n\r\n'
+        return self.raw_head + connection
@@ -1,3 +1,7 @@
+import base64
+import sys
+
+
 def decode_headers(headers):
     decoded_headers = {}
     for k, v in headers.items():
@@ -13,3 +17,35 @@ def decode_headers(headers):
         else:
             decoded_headers[k] = v
     return decoded_headers
+
+
+def freeze_headers(headers):
+    """
+    Freeze recorded headers into a tuple of (name, value) pairs. Names are interned, so the many packets of a
+    recording share a single copy of every header name.
+    """
+    if isinstance(headers, tuple):
+        return headers
+    return tuple((sys.intern(name), value) for name, value in headers.items())
+
+
+def decode_body(body_data, blobs=None):
+    """
+    Decode body based on its encoding
+    :param blobs: BlobStore of the recording, bodies stored in it are returned as memoryview slices
+    """
+    if isinstance(body_data, dict):
+        encoding = body_data.get('encoding')
+        data = body_data.get('data', '')
+
+        if encoding == 'blob':
+            if blobs is None:
+                raise ValueError(f"Body {body_data.get('sha256')} is stored in a blob file that was not found")
+            return blobs.get(body_data)
+        elif encoding == 'base64':
+            return base64.b64decode(data)
+        elif encoding == 'utf-8':
+            return data.encode('utf-8')
+        else:
+            return data.encode('utf-8')
+    return body_data.encode('utf-8') if isinstance(body_data, str) else body_data
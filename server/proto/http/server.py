@@ -1,341 +1,448 @@
-import json
+import logging
 import os
+import threading
 import time
-import xml.dom.minidom as minidom
 import xml.etree.ElementTree as ET
-from copy import deepcopy
-from datetime import datetime
-import base64
-from flask import Flask, request, jsonify, send_file
-from flask import make_response
-from scapy.all import wrpcap
+from flask import Flask, Response, request, jsonify
 from scapy.layers.http import HTTP, HTTPRequest, HTTPResponse
 from scapy.layers.inet import IP, TCP
 from scapy.layers.l2 import Ether
 from scapy.packet import Raw
-from io import BytesIO
 
 from proto.http.http_request_packet import HttpRequestPacket
-from proto.http.http_response_packet import HttpResponsePacket
-from services.dict_utils import arrange_differences
-from services.file_service import load_schema
-from services.xml_utils import json_to_xml
+from proto.http.packet_index import DEFAULT_MATCH_MODE, MATCH_MODES, FuzzyPacketIndex, PacketIndex
+from proto.http.replay_response import ReplayResponse
+from proto.http.request_service import decode_body
+from proto.http.serving import serve
+from services.blob_store import open_blob_store
+from services.dict_utils import diff_values, similarity
+from services.file_service import load_projector
+from services.junit_writer import JunitReportWriter
+from services.log_service import setup_logging, stop_logging, truncate
+from services.metrics import Metrics, format_prometheus
+from services.pcap_writer import PcapStreamWriter, build_tcp_frame, frame_address
+from services.recording_layers import layer_paths, load_layered_recording
+from services.recording_store import RECORDING_FILE, RecordingReader, read_recording_keys, recording_path
+from services.run_log import RUN_LOG_FILE, RunLogWriter
+from services.xml_utils import diff_to_xml, json_to_xml
+
+
+# Readiness and metrics endpoints, answered without going through the matching
+READY_PATH = '/__shift/ready'
+METRICS_PATH = '/__shift/metrics'
+
+logger = logging.getLogger(__name__)
+
+
+def request_packet_from_dict(request_data):
+    return HttpRequestPacket(
+        source_ip=request_data['source_ip'],
+        destination_ip=request_data['destination_ip'],
+        source_port=int(request_data['source_port']),
+        destination_port=int(request_data['destination_port']),
+        method=request_data['method'],
+        path=request_data['path'],
+        headers=request_data['headers']
+    )
+
+
+class SharedRecording:
+    """
+    Read-only view of a recording: its reader, the (method, path) keys of its exchanges and its blob file.
+    It is opened once and shared by the matchers of every session replaying it, which only keep their own
+    consumption state.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.file_path = recording_path(directory)
+        self.reader = None
+        self.blobs = None
+        self.keys = []
+        # Readers seek a single file, reads of the sessions are serialized
+        self.lock = threading.Lock()
+        if self.file_path is not None:
+            self.blobs = open_blob_store(directory)
+            # Re-capture layers are replayed over the recording, their bodies are in its blob file
+            records = load_layered_recording(directory) if layer_paths(directory) else None
+            self.reader = RecordingReader(self.file_path, records)
+            self.keys = read_recording_keys(self.reader)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
 
 
 class PacketMatcher:
-    def __init__(self, packet_directory, apk_name):
+    def __init__(self, packet_directory, apk_name, session_name=None, mirror_path='junit_report.xml',
+                 match_mode=None, match_window=None, recording=None, run_id=None):
+        """
+        :param packet_directory: Directory of the recording
+        :param apk_name: Name of the app
+        :param session_name: Optional session name, reports of a session are kept in their own directory
+        :param mirror_path: Optional path where a copy of the JUnit report is kept
+        :param match_mode: 'exact' takes the first packet with the same method and path, 'fuzzy' the most similar
+                           packet among the next match_window ones sharing the route of the request
+        :param recording: Optional SharedRecording of the packet directory, opened by the matcher when not given
+        :param run_id: Optional name of the report directory, shared by the sessions of a sharded replay
+        """
         self.apk_name = apk_name
-        self.packets = []
+        self.match_mode = match_mode or DEFAULT_MATCH_MODE
+        if self.match_mode not in MATCH_MODES:
+            raise ValueError(f"Unknown match mode {self.match_mode}, expected one of {', '.join(MATCH_MODES)}")
+        self.index = FuzzyPacketIndex(window=match_window) if self.match_mode == 'fuzzy' else PacketIndex()
+        # Compiled corpus, aligned with the positions of the index and filled when an exchange is first needed
+        self.requests = []
+        self.responses = []
+        self.owns_recording = recording is None
+        self.recording = SharedRecording(packet_directory) if recording is None else recording
+        # Memory-mapped file of the large response bodies, if the recording has one
+        self.blobs = self.recording.blobs
+        self.reader = self.recording.reader
+        # The reader is shared with the report thread, which reads the requests that were never matched
+        self.reader_lock = self.recording.lock
         self.load_packets(packet_directory)
         self.request_number = 0
-        self.testsuite = ET.Element('testsuite', name='HTTP Request Comparison', tests=str(len(self.packets)))
-        self.compare_path = os.path.join(os.getcwd(), 'resources/http', self.apk_name, 'diff', str(int(time.time())))
+        self.compare_path = os.path.join(os.getcwd(), 'resources/http', self.apk_name, 'diff',
+                                         run_id or str(int(time.time())))
+        if session_name:
+            self.compare_path = os.path.join(self.compare_path, session_name)
         os.makedirs(self.compare_path, exist_ok=True)
+        self.report = JunitReportWriter(
+            os.path.join(self.compare_path, 'junit_report.xml'),
+            suite_name=f'HTTP Request Comparison ({session_name})' if session_name else 'HTTP Request Comparison',
+            tests=len(self.index.packets),
+            pending=self.pending_testcases,
+            # also write it in the root of the project
+            mirror_path=mirror_path,
+        )
+        self.pcap = PcapStreamWriter(os.path.join(self.compare_path, 'http.pcap'))
+        self.run_log = RunLogWriter(os.path.join(self.compare_path, RUN_LOG_FILE))
+        self.metrics = Metrics()
+        self.metrics.gauge('remaining_requests', lambda: len(self.index))
+        # Requests can be served concurrently, the matching state is only changed while holding this lock
+        self.lock = threading.Lock()
 
     def decode_body(self, body_data):
-        """
-        Decode body based on its encoding
-        """
-        if isinstance(body_data, dict):
-            encoding = body_data.get('encoding')
-            data = body_data.get('data', '')
-
-            if encoding == 'base64':
-                return base64.b64decode(data)
-            elif encoding == 'utf-8':
-                return data.encode('utf-8')
-            else:
-                return data.encode('utf-8')
-        return body_data.encode('utf-8') if isinstance(body_data, str) else body_data
+        return decode_body(body_data)
 
-    def save_junit_report(self):
+    def pending_testcases(self):
         # Add every missing packet as a failed test for now
-        current_testsuite = deepcopy(self.testsuite)
         request_number = self.request_number + 1
-        for packet in self.packets:
+        for position in self.index.remaining():
+            with self.reader_lock:
+                packet = self.reader[position]
             testcase = ET.Element('testcase', name=f'Request {request_number}')
             failure = ET.Element('failure', message='Automation did not reach this request')
             failure.append(json_to_xml(packet['request'], initial_name='original'))
             testcase.append(failure)
-            current_testsuite.append(testcase)
+            yield testcase
             request_number += 1
 
-        rough_string = ET.tostring(current_testsuite, 'utf-8')
-        beautified = minidom.parseString(rough_string)
-        pretty_xml_as_string = beautified.toprettyxml(indent="  ")
+    def save_junit_report(self):
+        self.report.flush()
 
-        report_path = os.path.join(self.compare_path, 'junit_report.xml')
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(pretty_xml_as_string)
-        print(f'Current JUnit report generated at {report_path}')
-        # also write it in the root of the project
-        with open('junit_report.xml', 'w', encoding='utf-8') as f:
-            f.write(pretty_xml_as_string)
+    def close(self):
+        """
+        Flush and close the report, the pcap file and the run log.
+        """
+        self.report.close()
+        self.pcap.close()
+        self.run_log.close()
+        profile_path = self.metrics.dump_profile(os.path.join(self.compare_path, 'profile.prof'))
+        if profile_path:
+            logger.info("Profile saved to: %s", profile_path)
+        if self.owns_recording:
+            self.recording.close()
 
     def compare_packets(self, incoming_request):
-        if not self.packets:
-            print("All requests compared")
-            self.save_junit_report()
-            return -1
-
-        packet_number = -1
-        for i, packet in enumerate(self.packets):
-            if packet['request']['method'] == incoming_request['method'] and packet['request']['path'] == incoming_request['path']:
-                packet_number = i
-                break
-
-        if packet_number == -1:
-            print("No matching packet found")
-            return None
-
-        original_packet = self.packets.pop(packet_number)
+        """
+        Match an incoming request and persist the outcome (report, diff files) before returning.
+        :return: The ReplayResponse to send, None if no recorded packet matches, -1 once every request was compared
+        """
+        with self.metrics.profiling():
+            result, persist = self.match_packets(incoming_request)
+            with self.metrics.span('persist'):
+                persist()
+        return result
 
-        testcase = ET.Element('testcase', name=f'Request {self.request_number + 1}')
-        schema = load_schema(self.apk_name)
+    def match_packets(self, incoming_request):
+        """
+        Match an incoming request without doing any I/O.
+        :return: A (result, persist) tuple, persist being the callable writing the outcome to disk
+        """
+        with self.metrics.span('match'), self.lock:
+            return self._match_packets(incoming_request)
 
-        original_request = HttpRequestPacket(
-            source_ip=original_packet['request']['source_ip'],
-            destination_ip=original_packet['request']['destination_ip'],
-            source_port=original_packet['request']['source_port'],
-            destination_port=original_packet['request']['destination_port'],
-            method=original_packet['request']['method'],
-            path=original_packet['request']['path'],
-            headers=original_packet['request']['headers']
-        )
-        original_request.add_body(original_packet['request'].get('body', ''))
-        original_request.add_schema(schema.get('request', {}))
-
-        new_request = HttpRequestPacket(
-            source_ip=incoming_request['source_ip'],
-            destination_ip=incoming_request['destination_ip'],
-            source_port=int(incoming_request['source_port']),
-            destination_port=int(incoming_request['destination_port']),
-            method=incoming_request['method'],
-            path=incoming_request['path'],
-            headers=incoming_request['headers']
-        )
-        new_request.add_body(incoming_request.get('body', ''))
-        new_request.add_schema(schema.get('request', {}))
+    def record_unmatched(self, incoming_request, request_number):
+        """
+        Add a failure to the JUnit report for a request that matches no recorded packet.
+        """
+        testcase = ET.Element('testcase', name=f'Alleged request {request_number}')
+        failure = ET.Element('failure', message='No matching request found')
+        failure.append(json_to_xml(incoming_request, initial_name='new'))
+        testcase.append(failure)
+        self.report.add_testcase(testcase)
 
-        if original_request == new_request:
-            print('Request matched')
-            success = ET.Element('success')
-            testcase.append(success)
+    def record_result(self, request_number, original_filtered, new_filtered, diff):
+        """
+        Add the outcome of a comparison to the JUnit report. The XML of a failure is only built here, outside the
+        matching lock, and never for a success.
+        """
+        testcase = ET.Element('testcase', name=f'Request {request_number}')
+        if diff is None:
+            testcase.append(ET.Element('success'))
         else:
-            diff = arrange_differences(
-                original_request.to_filtered_dict(),
-                new_request.to_filtered_dict()
-            )
-
-            print('Request did not match')
             failure = ET.Element('failure', message='Request did not match')
-            failure.append(json_to_xml(original_request.to_filtered_dict(), initial_name='original'))
-            failure.append(json_to_xml(new_request.to_filtered_dict(), initial_name='new'))
-            failure.append(json_to_xml(diff, initial_name='diff'))
+            failure.append(json_to_xml(original_filtered, initial_name='original'))
+            failure.append(json_to_xml(new_filtered, initial_name='new'))
+            failure.append(diff_to_xml(diff))
             testcase.append(failure)
-        self.testsuite.append(testcase)
-        self.save_junit_report()
+        self.report.add_testcase(testcase)
+
+    def recorded_request(self, position, projector):
+        """
+        Return the recorded request at a position, projected with the current schema.
+        """
+        original_request = self.materialize(position)[0]
+        if original_request.projector is not projector:
+            original_request.add_schema(projector)
+        return original_request
+
+    def score(self, position, new_request, projector):
+        """
+        Similarity of the recorded request at a position with an incoming request, over the schema-selected fields.
+        """
+        original_request = self.recorded_request(position, projector)
+        if original_request.fingerprint() == new_request.fingerprint():
+            return 1.0
+        return similarity(original_request.flattened(), new_request.flattened())
+
+    def _match_packets(self, incoming_request):
+        if not self.index:
+            logger.info("All requests compared")
+            return -1, self.save_junit_report
+
+        metrics = self.metrics
+        metrics.inc('requests')
+        with metrics.span('schema'):
+            projector = load_projector(self.apk_name, 'request')
+            new_request = request_packet_from_dict(incoming_request)
+            new_request.add_body(incoming_request.get('body', ''))
+            new_request.add_schema(projector)
+
+        with metrics.span('lookup'):
+            if self.match_mode == 'fuzzy':
+                packet_number = self.index.take_best(incoming_request,
+                                                     lambda position: self.score(position, new_request, projector))
+            else:
+                packet_number = self.index.take(incoming_request['method'], incoming_request['path'])
+        if packet_number is None:
+            metrics.inc('unmatched')
+            request_number = self.request_number + 1
+            logger.info("#%d %s %s -> no matching packet", request_number, incoming_request['method'],
+                        truncate(incoming_request['path'], 200))
+            logger.debug("#%d unmatched request: %s", request_number, truncate(incoming_request))
+            return None, lambda: self.record_unmatched(incoming_request, request_number)
+
+        with metrics.span('materialize'):
+            original_request = self.recorded_request(packet_number, projector)
+            response = self.materialize(packet_number)[1]
+
+        with metrics.span('diff'):
+            original_filtered = original_request.to_filtered_dict()
+            new_filtered = new_request.to_filtered_dict()
+            # Equal fingerprints need no traversal, the deep diff only runs on a mismatch
+            if original_request.fingerprint() == new_request.fingerprint():
+                diff = None
+            else:
+                diff = diff_values(original_filtered, new_filtered)
+        metrics.inc('matched' if diff is None else 'mismatched')
 
         self.request_number += 1
+        request_number = self.request_number
+        logger.info("#%d %s %s -> packet %d %s", request_number, incoming_request['method'],
+                    truncate(incoming_request['path'], 200), packet_number,
+                    'matched' if diff is None else f'did not match ({len(diff)} differences)')
+        if diff is not None:
+            logger.debug("#%d differences: %s", request_number, truncate(diff))
 
-        response = HttpResponsePacket(
-            source_ip=original_packet['response']['source_ip'],
-            destination_ip=original_packet['response']['destination_ip'],
-            source_port=original_packet['response']['source_port'],
-            destination_port=original_packet['response']['destination_port'],
-            status_code=original_packet['response']['status_code'],
-            reason_phrase=original_packet['response']['reason_phrase'],
-            headers=original_packet['response']['headers']
-        )
-        response.add_body(original_packet['response'].get('body', ''))
-        self.save_packet(original_request.to_dict(), response.to_dict())
-        return response.to_dict()
+        # A consumed exchange is never matched again, only the persist callable still needs it
+        self.requests[packet_number] = self.responses[packet_number] = None
+
+        def persist():
+            self.record_result(request_number, original_filtered, new_filtered, diff)
+            self.save_packet(original_request.to_dict(), response.data)
+
+        return response, persist
 
     def save_packet(self, request_data, response_data):
         """
-        Save packet data to a JSON file, filtering fields based on a predefined schema.
+        Append a replayed exchange to the run log.
 
         :param request_data: Dictionary containing request data
         :param response_data: Dictionary containing response data
         """
-        # Filter data based on schema
-        packet_data = {
-            'request': request_data,
-            'response': response_data
-        }
-
-        # Generate unique filename
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-        file_name = f"packet_{timestamp}.json"
-        file_path = os.path.join(self.compare_path, file_name)
-
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-        # Save filtered data
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(packet_data, f, ensure_ascii=False, indent=4)
-
-        print(f"Packet saved to: {file_path}")
+        self.run_log.write(request_data, response_data)
 
     def load_packets(self, directory):
         """
-        Load all JSON packet files from the specified directory.
+        Index the recorded packets of the specified directory by method and path only,
+        exchanges are read and compiled when they are first needed.
         """
-        file_name = "packets.json"
-        filepath = os.path.join(directory, file_name)
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                packets_loaded = json.load(f)
-                for packet in packets_loaded:
-                    self.packets.append(packet)
-                print(f"Loaded {len(self.packets)} packets from {filepath}")
+        filepath = self.recording.file_path
+        if filepath is not None:
+            for method, path in self.recording.keys:
+                self.index.add({'request': {'method': method, 'path': path}})
+            self.requests = [None] * len(self.index.packets)
+            self.responses = [None] * len(self.index.packets)
+            logger.info("Indexed %d packets from %s", len(self.index.packets), filepath)
         else:
-            print(f"No packets found in {directory}. There should be a file named {file_name} with packets.")
-
-
-def create_app(packet_directory, app_name):
-    app = Flask(__name__)
-    packet_matcher = PacketMatcher(packet_directory, app_name)
-
-    @app.before_request
-    def catch_all():
-        incoming_request = {
-            'source_ip': request.remote_addr,
-            'destination_ip': request.host,
-            'source_port': request.environ.get('REMOTE_PORT'),
-            'destination_port': request.environ.get('SERVER_PORT'),
-            'method': request.method,
-            'path': request.path,
-            'headers': dict(request.headers)
-        }
-        if request.data:
-            incoming_request['body'] = request.data.decode()
+            logger.warning("No packets found in %s. There should be a file named %s with packets.",
+                           directory, RECORDING_FILE)
 
+    def materialize(self, position):
+        """
+        Read the recorded exchange at a position and compile it into ready-to-use request and response objects.
+        :return: A (HttpRequestPacket, ReplayResponse) tuple
+        """
+        if self.requests[position] is None:
+            with self.reader_lock:
+                packet = self.reader[position]
+            original_request = request_packet_from_dict(packet['request'])
+            original_request.add_body(packet['request'].get('body', ''))
+            self.requests[position] = original_request
+            self.responses[position] = ReplayResponse.from_dict(packet['response'],
+                                                                packet['request'].get('timestamp'), self.blobs)
+        return self.requests[position], self.responses[position]
+
+
+def build_request_frame(incoming_request, raw=False):
+    body = incoming_request.get('body', '').encode()
+    if raw:
+        payload = f"{incoming_request['method']} {incoming_request['path']} HTTP/1.1\r\n\r\n".encode() + body
+        return build_tcp_frame(incoming_request['source_ip'], incoming_request['destination_ip'],
+                               incoming_request['source_port'], incoming_request['destination_port'], payload)
+    return Ether() / IP(src=frame_address(incoming_request['source_ip']),
+                        dst=frame_address(incoming_request['destination_ip'])) / \
+        TCP(sport=int(incoming_request['source_port'] or 0), dport=int(incoming_request['destination_port'] or 0)) / \
+        HTTP() / \
+        HTTPRequest(
+            Method=incoming_request['method'].encode(),
+            Path=incoming_request['path'].encode(),
+            Http_Version=b"HTTP/1.1",
+        ) / \
+        Raw(load=body)
+
+
+def build_response_frame(response, response_body, raw=False):
+    if raw:
+        payload = f"HTTP/1.1 {response['status_code']} {response['reason_phrase']}\r\n\r\n".encode() + response_body
+        return build_tcp_frame(response['source_ip'], response['destination_ip'],
+                               response['source_port'], response['destination_port'], payload)
+    return Ether() / IP(src=frame_address(response['source_ip']), dst=frame_address(response['destination_ip'])) / \
+        TCP(sport=int(response['source_port']), dport=int(response['destination_port'])) / \
+        HTTP() / \
+        HTTPResponse(
+            Status_Code=response['status_code'].encode(),
+            Reason_Phrase=response['reason_phrase'].encode(),
+            Http_Version=b"HTTP/1.1",
+        ) / \
+        Raw(load=bytes(response_body))
+
+
+def incoming_request_from_flask():
+    incoming_request = {
+        'source_ip': request.remote_addr,
+        'destination_ip': request.host,
+        'source_port': request.environ.get('REMOTE_PORT'),
+        'destination_port': request.environ.get('SERVER_PORT'),
+        'method': request.method,
+        'path': request.path,
+        'headers': dict(request.headers)
+    }
+    if request.query_string:
+        incoming_request['query'] = request.query_string.decode()
+    if request.data:
+        incoming_request['body'] = request.data.decode()
+    return incoming_request
+
+
+def replay_request(packet_matcher, incoming_request):
+    """
+    Compare an incoming request with the recording and build the replayed response.
+    :return: The Flask response, or None once every recorded request was compared
+    """
+    metrics = packet_matcher.metrics
+    with metrics.span('request'):
         response = packet_matcher.compare_packets(incoming_request)
 
-        pcap_file_path = os.path.join(packet_matcher.compare_path, 'http.pcap')
-        request_packet = Ether() / IP(src=incoming_request['source_ip'], dst=incoming_request['destination_ip']) / \
-                         TCP(sport=int(incoming_request['source_port']),
-                             dport=int(incoming_request['destination_port'])) / \
-                         HTTP() / \
-                         HTTPRequest(
-                             Method=incoming_request['method'].encode(),
-                             Path=incoming_request['path'].encode(),
-                             Http_Version=b"HTTP/1.1",
-                         ) / \
-                         Raw(load=incoming_request.get('body', '').encode())
-        wrpcap(pcap_file_path, request_packet, append=True)
-
-        print(f"Packet pcap updated to: {pcap_file_path}")
+        pcap = packet_matcher.pcap
+        with metrics.span('pcap'):
+            if pcap.enabled:
+                pcap.write(build_request_frame(incoming_request, pcap.raw))
+                if response not in (None, -1):
+                    pcap.write(build_response_frame(response.data, response.body, pcap.raw))
 
         if response == -1:
-            os._exit(0)
+            return None
 
         if response:
-            # Create response packet for pcap
-            response_body = packet_matcher.decode_body(response.get('body', ''))
-            response_packet = Ether() / IP(src=response['source_ip'], dst=response['destination_ip']) / \
-                              TCP(sport=int(response['source_port']), dport=int(response['destination_port'])) / \
-                              HTTP() / \
-                              HTTPResponse(
-                                  Status_Code=response['status_code'].encode(),
-                                  Reason_Phrase=response['reason_phrase'].encode(),
-                                  Http_Version=b"HTTP/1.1",
-                              ) / \
-                              Raw(load=response_body)
-            wrpcap(pcap_file_path, response_packet, append=True)
-
-            content_type = response['headers'].get('Content_Type', 'text/plain')
-
-            # Handle binary content (images, etc.)
-            if content_type.startswith('image/') or 'octet-stream' in content_type:
-                decoded_body = packet_matcher.decode_body(response['body'])
-                return send_file(
-                    BytesIO(decoded_body),
-                    mimetype=content_type
-                )
-
-            # Handle regular responses
-            decoded_body = packet_matcher.decode_body(response['body'])
-            if isinstance(decoded_body, bytes):
-                decoded_body = decoded_body.decode('utf-8', errors='replace')
-
-            flask_response = make_response(decoded_body)
-            flask_response.content_type = content_type
-            flask_response.status_code = int(response['status_code'])
-
-            # Set headers
-            for header, value in response['headers'].items():
-                if header in ["Transfer_Encoding", "Content_Encoding", "Content_Length"]:
-                    continue
-                elif header == "Unknown_Headers":
-                    for h, v in value.items():
-                        flask_response.headers[h.replace('_', '-')] = v
-                elif header in ['Set-Cookie', 'Set_Cookie']:
-                    for cookie in value.split('§'):
-                        cookie = cookie.strip()
-                        if not cookie:
-                            continue
-
-                        parts = cookie.split('=', 1)
-                        if len(parts) != 2:
-                            continue
-
-                        cookie_name, rest = parts
-                        cookie_parts = rest.split(';')
-                        cookie_value = cookie_parts[0]
-
-                        kwargs = {}
-                        for part in cookie_parts[1:]:
-                            part = part.strip()
-                            if '=' in part:
-                                k, v = part.split('=', 1)
-                                k = k.lower()
-                                if k == 'expires':
-                                    try:
-                                        kwargs['expires'] = datetime.strptime(v, '%a, %d %b %Y %H:%M:%S %Z')
-                                    except ValueError:
-                                        continue
-                                elif k == 'max-age':
-                                    try:
-                                        kwargs['max_age'] = int(v)
-                                    except ValueError:
-                                        continue
-                                elif k == 'samesite':
-                                    kwargs['samesite'] = v
-                            elif part.lower() == 'httponly':
-                                kwargs['httponly'] = True
-
-                        flask_response.set_cookie(cookie_name, cookie_value, **kwargs)
-                else:
-                    flask_response.headers[header.replace('_', '-')] = value
-
-            return flask_response
-
-        # Add failure to JUnit report
-        testcase = ET.Element('testcase', name=f'Alleged request {packet_matcher.request_number + 1}')
-        failure = ET.Element('failure', message='No matching request found')
-        failure.append(json_to_xml(incoming_request, initial_name='new'))
-        testcase.append(failure)
-        packet_matcher.testsuite.append(testcase)
-        packet_matcher.save_junit_report()
+            with metrics.span('response'):
+                return response.to_flask_response()
 
         return jsonify({"error": "No matching packet found"}), 404
 
+
+def metrics_response(snapshots):
+    """
+    Render metric snapshots for the metrics endpoint, as JSON with ?format=json and in Prometheus text otherwise.
+    :param snapshots: List of (labels, snapshot) pairs
+    """
+    if request.args.get('format') == 'json':
+        return jsonify([{'labels': labels, **snapshot} for labels, snapshot in snapshots])
+    return Response(format_prometheus(snapshots), mimetype='text/plain; version=0.0.4')
+
+
+def create_app(packet_directory, app_name, serve_mode='dev', run_id=None):
+    app = Flask(__name__)
+    packet_matcher = PacketMatcher(packet_directory, app_name, run_id=run_id)
+    app.config['REPLAY_BACKEND'] = packet_matcher
+    app.config['SHUTDOWN_EVENT'] = threading.Event()
+
+    @app.before_request
+    def catch_all():
+        if request.path == READY_PATH:
+            return jsonify({"ready": True, "packets": len(packet_matcher.index.packets),
+                            "remaining": len(packet_matcher.index)})
+        if request.path == METRICS_PATH:
+            return metrics_response([({'app': app_name}, packet_matcher.metrics.snapshot())])
+        response = replay_request(packet_matcher, incoming_request_from_flask())
+        if response is None:
+            if serve_mode == 'dev':
+                packet_matcher.close()
+                stop_logging()
+                os._exit(0)
+            # Let the serving loop drain the requests in flight and shut down cleanly
+            app.config['SHUTDOWN_EVENT'].set()
+            return jsonify({"error": "All requests compared"}), 404
+        return response
+
     return app
 
 
-def run_server(packet_directory, host='0.0.0.0', port=80):
+def run_server(packet_directory, host='0.0.0.0', port=80, serve_mode='dev', threads=8, latency='off', run_id=None):
+    setup_logging()
     app_name = packet_directory
     packet_directory = "resources/http/" + packet_directory
-    app = create_app(packet_directory, app_name)
-
-    pkt = os.listdir(packet_directory)
-    try:
-        pkt.remove("diff")
-    except ValueError:
-        pass
-    print(f"Starting server on {host}:{port}")
-    print(f"Using packets from directory: {packet_directory}")
-    app.run(host=host, port=port, debug=True)
\ No newline at end of file
+    if serve_mode == 'async':
+        from proto.http.async_server import run_async_server
+
+        logger.info("Using packets from directory: %s", packet_directory)
+        run_async_server(packet_directory, app_name, host, port, latency, run_id)
+        return
+    app = create_app(packet_directory, app_name, serve_mode, run_id)
+
+    logger.info("Starting server on %s:%s", host, port)
+    logger.info("Using packets from directory: %s", packet_directory)
+    serve(app, host, port, serve_mode, threads)
\ No newline at end of file
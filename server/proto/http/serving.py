@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+SERVE_MODES = ('dev', 'threaded', 'waitress')
+
+logger = logging.getLogger(__name__)
+
+
+class DrainMiddleware:
+    """
+    WSGI middleware keeping track of the requests in flight, so the server can wait for them before exiting.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self.condition:
+            self.active += 1
+        try:
+            # Responses are fully built by the replay app, so they can be materialized here
+            result = self.app(environ, start_response)
+            try:
+                return list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def wait_idle(self, timeout=10.0):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.active == 0, timeout=timeout)
+
+
+def serve(app, host, port, mode='dev', threads=8):
+    """
+    Serve the replay app until its shutdown event is set.
+
+    :param app: Flask app built by create_app or create_multi_app
+    :param mode: 'dev' for Flask's debug server, 'threaded' for Werkzeug's threaded server,
+                 'waitress' for a multi-threaded waitress server
+    :param threads: Number of worker threads in waitress mode
+    """
+    if mode not in SERVE_MODES:
+        raise ValueError(f"Unknown serve mode {mode}, expected one of {', '.join(SERVE_MODES)}")
+
+    if mode == 'dev':
+        try:
+            app.run(host=host, port=port, debug=True)
+        finally:
+            # Closing the backend writes the final reports (and merges the shard reports of a session router)
+            app.config['REPLAY_BACKEND'].close()
+        return
+
+    shutdown_event = app.config['SHUTDOWN_EVENT']
+    wsgi_app = DrainMiddleware(app.wsgi_app)
+    app.wsgi_app = wsgi_app
+
+    if mode == 'threaded':
+        from werkzeug.serving import make_server
+
+        server = make_server(host, port, app, threaded=True)
+        stop = server.shutdown
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+    else:
+        try:
+            from waitress import create_server
+        except ImportError:
+            raise RuntimeError("The waitress serve mode needs the waitress package (pip install waitress)")
+
+        from waitress import wasyncore
+
+        server = create_server(app, host=host, port=port, threads=threads)
+
+        def stop():
+            # The workers finish their tasks first, then the loop sends the responses still buffered in the channels
+            server.task_dispatcher.shutdown(cancel_pending=False)
+            deadline = time.monotonic() + 5.0
+            while time.monotonic() < deadline and \
+                    any(getattr(channel, 'total_outbufs_len', 0) for channel in list(server._map.values())):
+                time.sleep(0.05)
+            # The sockets are closed by the loop thread itself, which then leaves its loop
+            server.trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+            thread.join(5.0)
+
+        thread = threading.Thread(target=server.run, daemon=True)
+
+    thread.start()
+    logger.info("Serving in %s mode on %s:%s", mode, host, port)
+    try:
+        while not shutdown_event.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+    # Let the requests in flight finish before closing the reports
+    wsgi_app.wait_idle()
+    stop()
+    app.config['REPLAY_BACKEND'].close()
@@ -0,0 +1,242 @@
+import ipaddress
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+from proto.http.server import (METRICS_PATH, READY_PATH, PacketMatcher, SharedRecording,
+                               incoming_request_from_flask, metrics_response, replay_request)
+from proto.http.serving import serve
+from services.junit_writer import merge_reports
+from services.log_service import setup_logging
+from services.recording_store import iter_recording, recording_path
+
+SESSION_HEADER = 'X-Shift-Session'
+ROUTE_MODES = ('host', 'client', 'header')
+# Session names become directory names of the run, they can not walk out of it
+SESSION_NAME_PATTERN = re.compile(r'[A-Za-z0-9_:-][A-Za-z0-9_.:-]*')
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_host(host):
+    host = (host or '').split(':', 1)[0].lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def is_loopback(address):
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def list_recordings(resources_dir='resources/http'):
+    """
+    List the apps having a recording in the resources directory.
+    """
+    if not os.path.isdir(resources_dir):
+        return []
+    return sorted(name for name in os.listdir(resources_dir)
+                  if recording_path(os.path.join(resources_dir, name)) is not None)
+
+
+def recording_host(packet_directory):
+    """
+    Return the host of a recording, read from the first recorded request.
+    """
+    for packet in iter_recording(packet_directory):
+        return normalize_host(packet['request']['headers'].get('Host'))
+    return None
+
+
+class Session:
+    def __init__(self, key, matcher):
+        self.key = key
+        self.matcher = matcher
+        self.last_used = time.monotonic()
+
+
+class SessionRouter:
+    """
+    Route incoming requests of several apps and clients to their own PacketMatcher.
+
+    Recordings are loaded lazily on the first request of an app and shared read-only by all its sessions, every
+    session has its own cursor and report directory, and sessions left idle for idle_timeout seconds are closed and
+    evicted from memory. The sessions of a router are the shards of one run: their reports are kept under the same
+    run directory, and the reports of the closed sessions are merged into its junit_report.xml.
+    """
+
+    def __init__(self, app_names, route='host', idle_timeout=600.0, resources_dir='resources/http'):
+        """
+        :param app_names: Apps that can be replayed
+        :param route: 'host' for one session per app chosen by Host header, 'client' for one session per app and
+                      client address, 'header' for sessions named by the X-Shift-Session header ("<app>[/<session>]").
+                      Client addresses only tell devices apart when they connect directly: through adb reverse or
+                      another local forwarder they all come from the loopback address and share one session.
+        :param idle_timeout: Seconds after which an idle session is evicted
+        """
+        if route not in ROUTE_MODES:
+            raise ValueError(f"Unknown route mode {route}, expected one of {', '.join(ROUTE_MODES)}")
+        self.route = route
+        self.idle_timeout = idle_timeout
+        self.resources_dir = resources_dir
+        self.app_names = list(app_names)
+        self.hosts = {}
+        for app_name in self.app_names:
+            host = recording_host(os.path.join(resources_dir, app_name))
+            if host:
+                self.hosts[host] = app_name
+        self.run_id = str(int(time.time()))
+        self.recordings = {}
+        # Complete reports of the closed sessions, by app and shard directory
+        self.closed_reports = {}
+        self.sessions = {}
+        # Number of times every session was opened, a session reopened after being closed gets its own directory
+        self.generations = {}
+        self.loopback_warned = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.evict_thread = threading.Thread(target=self._evict_loop, daemon=True)
+        self.evict_thread.start()
+
+    def session_key(self, incoming_request):
+        """
+        Compute the (app, session) key of an incoming request.
+        :return: The key, or None if the request can not be routed to a known app
+        """
+        headers = incoming_request['headers']
+        if self.route == 'header' and headers.get(SESSION_HEADER):
+            app_name, _, session_name = headers[SESSION_HEADER].partition('/')
+        else:
+            app_name = self.hosts.get(normalize_host(headers.get('Host')))
+            if app_name is None and len(self.app_names) == 1:
+                app_name = self.app_names[0]
+            session_name = incoming_request['source_ip'] if self.route == 'client' else ''
+            if self.route == 'client' and not self.loopback_warned and is_loopback(session_name):
+                self.loopback_warned = True
+                logger.warning("Clients connect from the loopback address (adb reverse?), they all share one "
+                               "session: send the %s header and route by header to shard them", SESSION_HEADER)
+        if app_name not in self.app_names:
+            return None
+        if session_name and not SESSION_NAME_PATTERN.fullmatch(session_name):
+            logger.warning("Invalid session name %r for %s", session_name, app_name)
+            return None
+        return app_name, session_name or 'default'
+
+    def resolve(self, incoming_request):
+        """
+        Return the session of an incoming request, loading its recording if needed.
+        """
+        key = self.session_key(incoming_request)
+        if key is None:
+            return None
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                app_name, session_name = key
+                packet_directory = os.path.join(self.resources_dir, app_name)
+                recording = self.recordings.get(app_name)
+                if recording is None:
+                    recording = self.recordings[app_name] = SharedRecording(packet_directory)
+                generation = self.generations[key] = self.generations.get(key, 0) + 1
+                if generation > 1:
+                    # The report of the previous session is complete, it is not overwritten
+                    session_name = f'{session_name}.{generation}'
+                matcher = PacketMatcher(packet_directory, app_name, session_name=session_name, mirror_path=None,
+                                        recording=recording, run_id=self.run_id)
+                session = Session(key, matcher)
+                self.sessions[key] = session
+                logger.info("Session %s/%s opened", app_name, session_name)
+            session.last_used = time.monotonic()
+            return session
+
+    def close_session(self, key):
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session is not None:
+            session.matcher.close()
+            logger.info("Session %s/%s closed", key[0], key[1])
+            with self.lock:
+                reports = self.closed_reports.setdefault(key[0], {})
+                reports[session.matcher.compare_path] = session.matcher.report.report_path
+            self.merge_reports(key[0])
+
+    def run_path(self, app_name):
+        return os.path.join(os.getcwd(), self.resources_dir, app_name, 'diff', self.run_id)
+
+    def merge_reports(self, app_name):
+        """
+        Merge the reports of the closed sessions of an app into the junit_report.xml of the run directory.
+        The reports of open sessions are still being written, they are merged once their session is closed.
+        """
+        with self.lock:
+            reports = sorted(self.closed_reports.get(app_name, {}).values())
+        if not reports:
+            return
+        output_path = os.path.join(self.run_path(app_name), 'junit_report.xml')
+        tests, failures = merge_reports(reports, output_path)
+        logger.info("Merged report of %s: %d tests, %d failures in %s", app_name, tests, failures, output_path)
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, session in self.sessions.items() if now - session.last_used > self.idle_timeout]
+        for key in idle:
+            self.close_session(key)
+
+    def _evict_loop(self):
+        while not self.stop_event.wait(min(30.0, self.idle_timeout)):
+            self.evict_idle()
+
+    def close(self):
+        self.stop_event.set()
+        for key in list(self.sessions):
+            self.close_session(key)
+        for recording in self.recordings.values():
+            recording.close()
+
+
+def create_multi_app(router: SessionRouter):
+    app = Flask(__name__)
+    app.config['REPLAY_BACKEND'] = router
+    app.config['SHUTDOWN_EVENT'] = threading.Event()
+
+    @app.before_request
+    def catch_all():
+        if request.path == READY_PATH:
+            return jsonify({"ready": True, "apps": len(router.app_names)})
+        if request.path == METRICS_PATH:
+            with router.lock:
+                sessions = list(router.sessions.values())
+            return metrics_response([({'app': session.key[0], 'session': session.key[1]},
+                                      session.matcher.metrics.snapshot()) for session in sessions])
+        incoming_request = incoming_request_from_flask()
+        session = router.resolve(incoming_request)
+        if session is None:
+            logger.info("No recording for host %s", incoming_request['headers'].get('Host'))
+            return jsonify({"error": "No recording found for this request"}), 404
+
+        response = replay_request(session.matcher, incoming_request)
+        if response is None:
+            router.close_session(session.key)
+            return jsonify({"error": "All requests compared"}), 404
+        return response
+
+    return app
+
+
+def run_multi_server(app_names=None, host='0.0.0.0', port=80, route='host', idle_timeout=600.0,
+                     serve_mode='threaded', threads=8):
+    """
+    Serve several recordings from one process, routing every request to its own session.
+    """
+    setup_logging()
+    app_names = app_names or list_recordings()
+    router = SessionRouter(app_names, route=route, idle_timeout=idle_timeout)
+    app = create_multi_app(router)
+    logger.info("Starting multi-app server on %s:%s for %s", host, port, ', '.join(app_names))
+    serve(app, host, port, serve_mode, threads)
@@ -0,0 +1,540 @@
+import socket
+import struct
+from collections import OrderedDict, deque
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+ACK = 0x10
+
+# pcap link types understood by parse_frame
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+HTTP_METHODS = (b'GET ', b'POST ', b'PUT ', b'DELETE ', b'HEAD ', b'OPTIONS ', b'PATCH ', b'CONNECT ', b'TRACE ')
+
+_SEQ_MOD = 1 << 32
+
+# Largest body buffer allocated up front from a Content-Length header
+MAX_PREALLOCATION = 1024 * 1024
+
+
+def parse_frame(data, linktype=LINKTYPE_ETHERNET):
+    """
+    Extract the TCP segment of a raw IPv4 frame without dissecting it with scapy.
+    :return: A (src, sport, dst, dport, seq, flags, payload) tuple, or None if the frame is not IPv4/TCP
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 14
+        ethertype = data[12:14]
+        while ethertype == b'\x81\x00' and len(data) >= offset + 4:
+            # 802.1Q VLAN tag
+            ethertype = data[offset + 2:offset + 4]
+            offset += 4
+        if ethertype != b'\x08\x00':
+            return None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if data[14:16] != b'\x08\x00':
+            return None
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if data[0:2] != b'\x08\x00':
+            return None
+        offset = 20
+    elif linktype == LINKTYPE_NULL:
+        if data[0:4] not in (b'\x02\x00\x00\x00', b'\x00\x00\x00\x02'):
+            return None
+        offset = 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        offset = 0
+    else:
+        return None
+
+    if len(data) < offset + 20 or data[offset] >> 4 != 4 or data[offset + 9] != 6:
+        return None
+    ihl = (data[offset] & 0x0f) * 4
+    total_length = struct.unpack_from('!H', data, offset + 2)[0]
+    src = socket.inet_ntoa(data[offset + 12:offset + 16])
+    dst = socket.inet_ntoa(data[offset + 16:offset + 20])
+    tcp = offset + ihl
+    if len(data) < tcp + 20:
+        return None
+    sport, dport, seq = struct.unpack_from('!HHI', data, tcp)
+    data_offset = (data[tcp + 12] >> 4) * 4
+    flags = data[tcp + 13]
+    # total_length excludes the Ethernet padding of small frames, it is 0 with TCP segmentation offload
+    end = offset + total_length if total_length else len(data)
+    payload = bytes(data[tcp + data_offset:end])
+    return src, sport, dst, dport, seq, flags, payload
+
+
+def _header_value(head, name):
+    """
+    Return the value of a header in a raw HTTP head, or None.
+    """
+    name = name.lower().encode('latin-1')
+    for line in head.split(b'\r\n')[1:]:
+        key, sep, value = line.partition(b':')
+        if sep and key.strip().lower() == name:
+            return value.strip()
+    return None
+
+
+class HttpMessage:
+    __slots__ = ('head', 'body', 'timestamp')
+
+    def __init__(self, head, body, timestamp):
+        self.head = head
+        self.body = body
+        self.timestamp = timestamp
+
+    @property
+    def method(self):
+        return self.head.split(b' ', 1)[0].decode('latin-1')
+
+
+class HttpStreamParser:
+    """
+    Incremental HTTP/1.1 parser for one direction of a TCP connection.
+    Handles Content-Length, chunked and (for responses) connection-close delimited bodies.
+    """
+
+    def __init__(self, is_response, request_method=None):
+        """
+        :param is_response: True for the server to client direction
+        :param request_method: Callable returning the method of the request the next response answers
+        """
+        self.is_response = is_response
+        self.request_method = request_method
+        self.buffer = bytearray()
+        self._reset()
+
+    def _reset(self):
+        self.state = 'head'
+        self.head = None
+        self.body = None
+        self.remaining = 0
+        self.filled = None
+        self.timestamp = None
+
+    def _complete(self):
+        if self.body is None:
+            body = b''
+        elif self.filled is not None:
+            body = bytes(memoryview(self.body)[:self.filled])
+        else:
+            body = bytes(self.body)
+        message = HttpMessage(self.head, body, self.timestamp)
+        self._reset()
+        return message
+
+    def _start_body(self, head):
+        self.head = head
+        first_line = head.split(b'\r\n', 1)[0]
+        if self.is_response:
+            try:
+                status = int(first_line.split(b' ', 2)[1])
+            except (IndexError, ValueError):
+                status = 200
+            if 100 <= status < 200 and status != 101:
+                # Interim response, the final one follows on the same connection
+                self._reset()
+                return None
+            method = self.request_method() if self.request_method else None
+            if method == 'HEAD' or status in (204, 304):
+                return self._complete()
+
+        transfer_encoding = _header_value(head, 'Transfer-Encoding')
+        content_length = _header_value(head, 'Content-Length')
+        if transfer_encoding is not None and b'chunked' in transfer_encoding.lower():
+            self.body = bytearray()
+            self.state = 'chunk-size'
+        elif content_length is not None:
+            try:
+                self.remaining = int(content_length)
+            except ValueError:
+                self.remaining = 0
+            if not self.remaining:
+                return self._complete()
+            # The size is known, fill a preallocated buffer (grown on demand past MAX_PREALLOCATION)
+            self.body = bytearray(min(self.remaining, MAX_PREALLOCATION))
+            self.filled = 0
+            self.state = 'length'
+        elif self.is_response:
+            self.body = bytearray()
+            self.state = 'close'
+        else:
+            return self._complete()
+        return None
+
+    def feed(self, data, timestamp=None):
+        """
+        Add in-order bytes of the stream.
+        :return: The list of HttpMessage completed by these bytes
+        """
+        if self.state == 'head' and not self.buffer and self.timestamp is None:
+            self.timestamp = timestamp
+        self.buffer += data
+        messages = []
+        buffer = self.buffer
+        while buffer:
+            if self.state == 'head':
+                # Tolerate blank lines between messages
+                while buffer[:2] == b'\r\n':
+                    del buffer[:2]
+                end = buffer.find(b'\r\n\r\n')
+                if end == -1:
+                    break
+                head = bytes(buffer[:end + 4])
+                del buffer[:end + 4]
+                if self.timestamp is None:
+                    self.timestamp = timestamp
+                message = self._start_body(head)
+                if message is not None:
+                    messages.append(message)
+            elif self.state == 'length':
+                take = min(self.remaining, len(buffer))
+                self.body[self.filled:self.filled + take] = memoryview(buffer)[:take]
+                self.filled += take
+                del buffer[:take]
+                self.remaining -= take
+                if not self.remaining:
+                    messages.append(self._complete())
+            elif self.state == 'chunk-size':
+                end = buffer.find(b'\r\n')
+                if end == -1:
+                    break
+                try:
+                    self.remaining = int(bytes(buffer[:end]).split(b';', 1)[0].strip() or b'0', 16)
+                except ValueError:
+                    self.remaining = 0
+                del buffer[:end + 2]
+                self.state = 'chunk-data' if self.remaining else 'trailer'
+            elif self.state == 'chunk-data':
+                take = min(self.remaining, len(buffer))
+                self.body += buffer[:take]
+                del buffer[:take]
+                self.remaining -= take
+                if not self.remaining:
+                    self.state = 'chunk-end'
+            elif self.state == 'chunk-end':
+                if len(buffer) < 2:
+                    break
+                del buffer[:2]
+                self.state = 'chunk-size'
+            elif self.state == 'trailer':
+                end = buffer.find(b'\r\n')
+                if end == -1:
+                    break
+                del buffer[:end + 2]
+                if end == 0:
+                    messages.append(self._complete())
+            else:
+                # Body delimited by the end of the connection
+                self.body += buffer
+                buffer.clear()
+        if self.state == 'head' and not buffer:
+            self.timestamp = None
+        return messages
+
+    def finish(self):
+        """
+        Complete the message in progress when the stream ends. Only a response body delimited by the end of the
+        connection is complete then, a message cut before its Content-Length or last chunk is left truncated.
+        :return: The list of messages completed by the end of the stream
+        """
+        if self.state == 'close':
+            return [self._complete()]
+        return []
+
+    @property
+    def buffered(self):
+        return len(self.buffer) + (len(self.body) if self.body is not None else 0)
+
+
+class _Direction:
+    """
+    One direction of a TCP connection, reordering segments by sequence number.
+    """
+    __slots__ = ('next_seq', 'segments', 'segment_bytes', 'parser')
+
+    def __init__(self, parser):
+        self.next_seq = None
+        self.segments = {}
+        self.segment_bytes = 0
+        self.parser = parser
+
+    def _offset(self, seq):
+        """
+        Signed distance between a sequence number and the next expected one.
+        """
+        offset = (seq - self.next_seq) % _SEQ_MOD
+        return offset - _SEQ_MOD if offset >= _SEQ_MOD // 2 else offset
+
+    def _consume(self, offset, payload, timestamp):
+        if -offset >= len(payload):
+            # Retransmission of data already seen
+            return []
+        if offset:
+            payload = payload[-offset:]
+        self.next_seq = (self.next_seq + len(payload)) % _SEQ_MOD
+        return self.parser.feed(payload, timestamp)
+
+    def add(self, seq, payload, timestamp):
+        if self.next_seq is None:
+            self.next_seq = seq
+        offset = self._offset(seq)
+        if offset > 0:
+            previous = self.segments.get(seq)
+            if previous is not None:
+                self.segment_bytes -= len(previous)
+            self.segments[seq] = payload
+            self.segment_bytes += len(payload)
+            return []
+        messages = self._consume(offset, payload, timestamp)
+        # Drain the buffered segments that are now in order, they may overlap what was just added
+        while self.segments:
+            ready = sorted((seq for seq in self.segments if self._offset(seq) <= 0), key=self._offset)
+            if not ready:
+                break
+            for seq in ready:
+                payload = self.segments.pop(seq)
+                self.segment_bytes -= len(payload)
+                messages.extend(self._consume(self._offset(seq), payload, timestamp))
+        return messages
+
+    @property
+    def buffered(self):
+        return self.parser.buffered + self.segment_bytes
+
+
+class Exchange:
+    """
+    One request and its response, reassembled from a TCP connection.
+    """
+    __slots__ = ('client', 'server', 'request', 'response', 'frames')
+
+    def __init__(self, client, server, request, response, frames):
+        self.client = client
+        self.server = server
+        self.request = request
+        self.response = response
+        self.frames = frames
+
+
+class TcpConnection:
+    def __init__(self, client, server):
+        self.client = client
+        self.server = server
+        self.pending_requests = deque()
+        self.to_server = _Direction(HttpStreamParser(is_response=False))
+        self.to_client = _Direction(HttpStreamParser(is_response=True, request_method=self._pending_method))
+        self.frames = []
+        self.frame_bytes = 0
+        self.pending_bytes = 0
+        self.fin = set()
+        self.last_seen = 0.0
+        # Bytes of this connection counted in the reassembler memory usage
+        self.accounted = 0
+
+    def _pending_method(self):
+        return self.pending_requests[0].method if self.pending_requests else None
+
+    def _pair(self, responses):
+        exchanges = []
+        for response in responses:
+            if not self.pending_requests:
+                # Response without a captured request, nothing to record
+                continue
+            request = self.pending_requests.popleft()
+            self.pending_bytes -= len(request.head) + len(request.body)
+            exchanges.append(Exchange(self.client, self.server, request, response, self.frames))
+            self.frames = []
+            self.frame_bytes = 0
+        return exchanges
+
+    def add_frame(self, timestamp, frame):
+        self.frames.append((timestamp, frame))
+        self.frame_bytes += len(frame)
+
+    def add(self, source, seq, flags, payload, timestamp):
+        if source == self.client:
+            direction = self.to_server
+        else:
+            direction = self.to_client
+        if flags & SYN:
+            direction.next_seq = (seq + 1) % _SEQ_MOD
+            return []
+        if not payload:
+            return []
+        messages = direction.add(seq, payload, timestamp)
+        if direction is self.to_server:
+            for message in messages:
+                self.pending_requests.append(message)
+                self.pending_bytes += len(message.head) + len(message.body)
+            return []
+        return self._pair(messages)
+
+    def finish(self):
+        if self.to_client.segment_bytes:
+            # Segments missing before the end of the stream, the body would have a hole
+            return []
+        return self._pair(self.to_client.parser.finish())
+
+    @property
+    def incomplete(self):
+        """
+        True if ending the connection now would leave a request without response or a message truncated.
+        A response delimited by the end of the connection is completed by it and answers one pending request.
+        """
+        parser = self.to_client.parser
+        completes = parser.state == 'close' and not self.to_client.segment_bytes
+        return len(self.pending_requests) > completes or self.to_server.buffered > 0 or \
+            (self.to_client.buffered > 0 and not completes)
+
+    @property
+    def buffered(self):
+        return self.to_server.buffered + self.to_client.buffered + self.frame_bytes + self.pending_bytes
+
+
+class TcpReassembler:
+    """
+    Reassemble HTTP/1.1 exchanges from TCP segments.
+
+    Segments are reordered by sequence number into per-direction buffers and HTTP framing is parsed incrementally,
+    so keep-alive connections carrying several exchanges produce one Exchange per request/response pair.
+
+    The connection table is bounded: connections idle for idle_timeout seconds (of capture time) are closed, and the
+    least recently used ones are evicted when there are more than max_connections or when the buffered bytes go over
+    memory_budget. Evictions are counted in stats.
+    """
+
+    def __init__(self, on_exchange, server_ports=None, keep_frames=True, idle_timeout=120.0, max_connections=10000,
+                 memory_budget=256 * 1024 * 1024):
+        """
+        :param on_exchange: Callable receiving every reassembled Exchange
+        :param server_ports: Ports of the HTTP servers, guessed from SYN packets and request lines when not given
+        :param keep_frames: Keep the raw frames of every exchange (for the pcap output)
+        :param idle_timeout: Seconds without segments after which a connection is closed
+        :param max_connections: Maximum number of connections tracked at once
+        :param memory_budget: Maximum number of bytes buffered over all connections
+        """
+        self.on_exchange = on_exchange
+        self.server_ports = set(server_ports or ())
+        self.keep_frames = keep_frames
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.memory_budget = memory_budget
+        self.connections = OrderedDict()
+        self.buffered = 0
+        self.stats = {
+            'exchanges': 0,
+            'closed': 0,
+            'evicted_idle': 0,
+            'evicted_lru': 0,
+            'evicted_memory': 0,
+            'incomplete': 0,
+            'ignored_segments': 0,
+        }
+
+    def _connection(self, source, destination, flags, payload):
+        key = (source, destination) if source <= destination else (destination, source)
+        connection = self.connections.get(key)
+        if connection is not None:
+            self.connections.move_to_end(key)
+            return key, connection
+
+        if destination[1] in self.server_ports:
+            client, server = source, destination
+        elif source[1] in self.server_ports:
+            client, server = destination, source
+        elif flags & SYN and not flags & ACK:
+            client, server = source, destination
+        elif flags & SYN:
+            client, server = destination, source
+        elif payload.startswith(HTTP_METHODS):
+            client, server = source, destination
+        elif payload.startswith(b'HTTP/'):
+            client, server = destination, source
+        else:
+            # Middle of a connection we can not make sense of
+            return key, None
+        connection = TcpConnection(client, server)
+        self.connections[key] = connection
+        return key, connection
+
+    def _emit(self, exchanges):
+        for exchange in exchanges:
+            self.stats['exchanges'] += 1
+            self.on_exchange(exchange)
+
+    def _account(self, connection):
+        size = connection.buffered
+        self.buffered += size - connection.accounted
+        connection.accounted = size
+
+    def feed(self, timestamp, src, sport, dst, dport, seq, flags, payload, frame=None):
+        """
+        Add a TCP segment.
+        :param frame: Raw bytes of the captured frame, kept for the pcap output
+        """
+        source = (src, sport)
+        destination = (dst, dport)
+        key, connection = self._connection(source, destination, flags, payload)
+        if connection is None:
+            self.stats['ignored_segments'] += 1
+            return
+        connection.last_seen = timestamp
+        if self.keep_frames and frame is not None:
+            connection.add_frame(timestamp, frame)
+
+        self._emit(connection.add(source, seq, flags, payload, timestamp))
+
+        if flags & RST:
+            self.close(key)
+        elif flags & FIN:
+            connection.fin.add(source)
+            if source == connection.server or len(connection.fin) == 2:
+                self.close(key)
+        if key in self.connections:
+            self._account(connection)
+        self._evict(timestamp, key)
+
+    def _evict(self, now, current=None):
+        """
+        :param current: Connection being fed, never evicted for the memory budget while it is receiving data
+        """
+        connections = self.connections
+        while connections:
+            key, connection = next(iter(connections.items()))
+            if now - connection.last_seen > self.idle_timeout:
+                self.close(key, 'evicted_idle')
+            elif len(connections) > self.max_connections:
+                self.close(key, 'evicted_lru')
+            elif self.buffered > self.memory_budget and key != current:
+                self.close(key, 'evicted_memory')
+            else:
+                break
+
+    def close(self, key, reason='closed'):
+        connection = self.connections.pop(key, None)
+        if connection is None:
+            return
+        self.stats[reason] += 1
+        self.buffered -= connection.accounted
+        # Checked before finishing, which completes the message in progress when the end of the stream delimits it
+        if connection.incomplete:
+            self.stats['incomplete'] += 1
+        self._emit(connection.finish())
+
+    def flush(self):
+        """
+        Complete every connection, for instance at the end of a capture file.
+        """
+        for key in list(self.connections):
+            self.close(key)
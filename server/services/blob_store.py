@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import mmap
+import os
+
+BLOB_FILE = 'bodies.blob'
+# Response bodies larger than this many bytes are moved out of the recording into the blob file
+DEFAULT_BLOB_THRESHOLD = int(os.getenv('SHIFT_BLOB_THRESHOLD', '1024'))
+
+
+def _body_bytes(body):
+    """
+    Return the raw bytes of a recorded body, or None if it is already stored in a blob file.
+    """
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    if isinstance(body, dict):
+        encoding = body.get('encoding')
+        if encoding == 'base64':
+            return base64.b64decode(body.get('data', ''))
+        if encoding == 'blob':
+            return None
+        return body.get('data', '').encode('utf-8')
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return None
+
+
+def body_digest(body):
+    """
+    Return the sha256 of a recorded body, whether it is stored inline or in a blob file.
+    """
+    if isinstance(body, dict) and body.get('encoding') == 'blob':
+        return body['sha256']
+    data = _body_bytes(body)
+    return hashlib.sha256(data if data is not None else b'').hexdigest()
+
+
+class BlobWriter:
+    """
+    Append-only, content-addressed store of response bodies: identical bodies are written once and
+    referenced from the recording by sha256, offset and length.
+    """
+
+    def __init__(self, file_path, threshold=None):
+        self.file_path = file_path
+        self.threshold = DEFAULT_BLOB_THRESHOLD if threshold is None else threshold
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        self.file = open(file_path, 'ab')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.known = {}
+
+    def register(self, ref):
+        """
+        Remember a blob written by an earlier run so its content is not stored twice.
+        """
+        if ref['offset'] + ref['length'] <= self.size:
+            self.known[ref['sha256']] = ref
+
+    def put(self, data):
+        """
+        Store a body.
+        :return: The {'encoding': 'blob', ...} reference of the body
+        """
+        sha = hashlib.sha256(data).hexdigest()
+        ref = self.known.get(sha)
+        if ref is None:
+            ref = {'encoding': 'blob', 'sha256': sha, 'offset': self.size, 'length': len(data)}
+            self.file.write(data)
+            # The body must reach the OS before the record referencing it
+            self.file.flush()
+            self.size += len(data)
+            self.known[sha] = ref
+        return ref
+
+    def externalize(self, response_data):
+        """
+        Replace the body of a response by a blob reference if it is larger than the threshold.
+        """
+        body = response_data.get('body')
+        data = _body_bytes(body)
+        if data is not None and len(data) > self.threshold:
+            response_data['body'] = self.put(data)
+        return response_data
+
+    def sync(self):
+        if self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.sync()
+        self.file.close()
+
+
+class BlobStore:
+    """
+    Read-only view of a blob file. The file is memory-mapped and bodies are returned as memoryview slices,
+    so they are neither decoded nor copied and only the pages actually sent are loaded.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.map = None
+        self.view = memoryview(b'')
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+
+    def get(self, ref):
+        offset, length = ref['offset'], ref['length']
+        if offset + length > len(self.view):
+            raise ValueError(f"Blob {ref.get('sha256')} is out of the bounds of {self.file_path}")
+        return self.view[offset:offset + length]
+
+
+def open_blob_store(directory):
+    """
+    :return: The BlobStore of a recording directory, or None if its bodies are all inline
+    """
+    file_path = os.path.join(directory, BLOB_FILE)
+    return BlobStore(file_path) if os.path.isfile(file_path) else None
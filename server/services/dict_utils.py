@@ -1,8 +1,198 @@
-def arrange_differences(original, new):
-    diff = {}
-    for key, value in original.items():
-        if isinstance(value, dict):
-            diff[key] = arrange_differences(value, new.get(key, {}))
-        elif value != new.get(key):
-            diff[key] = {'original': value, 'new': new.get(key)}
-    return diff
\ No newline at end of file
+import hashlib
+import json
+from difflib import SequenceMatcher
+from urllib.parse import parse_qsl
+
+# Above this many element pairs, list elements are aligned by index instead of by content
+MAX_ALIGNMENT_COST = 1000000
+
+
+def _join(path, key):
+    return f'{path}.{key}' if path else str(key)
+
+
+def _parse_form(value):
+    """
+    Parse a form-encoded string into a dict. A repeated key keeps all its values, in order, as a list.
+    """
+    form = {}
+    for name, field in parse_qsl(value, keep_blank_values=True, strict_parsing=True):
+        if name not in form:
+            form[name] = field
+        elif isinstance(form[name], list):
+            form[name].append(field)
+        else:
+            form[name] = [form[name], field]
+    return form
+
+
+def _parse_body(value, key):
+    """
+    Parse a JSON or form-encoded string, only called once the raw strings are known to differ.
+    :return: The parsed value, or None if the string is neither
+    """
+    stripped = value.lstrip()
+    if stripped[:1] in ('{', '['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    if key == 'body' and '=' in value and ' ' not in value:
+        try:
+            return _parse_form(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _element_key(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return repr(value)
+
+
+def _diff(original, new, path, key, changes):
+    if original is new:
+        return
+    if type(original) is not type(new):
+        changes.append({'kind': 'changed', 'path': path, 'original': original, 'new': new})
+        return
+
+    if isinstance(original, dict):
+        for k, value in original.items():
+            if k in new:
+                _diff(value, new[k], _join(path, k), k, changes)
+            else:
+                changes.append({'kind': 'removed', 'path': _join(path, k), 'original': value, 'new': None})
+        for k, value in new.items():
+            if k not in original:
+                changes.append({'kind': 'added', 'path': _join(path, k), 'original': None, 'new': value})
+    elif isinstance(original, list):
+        _diff_lists(original, new, path, changes)
+    elif original != new:
+        if isinstance(original, str):
+            parsed_original = _parse_body(original, key)
+            parsed_new = _parse_body(new, key) if parsed_original is not None else None
+            if parsed_new is not None:
+                _diff(parsed_original, parsed_new, path, key, changes)
+                return
+        changes.append({'kind': 'changed', 'path': path, 'original': original, 'new': new})
+
+
+def _diff_lists(original, new, path, changes):
+    # Skip the common prefix and suffix, most list changes are local
+    start = 0
+    limit = min(len(original), len(new))
+    while start < limit and original[start] == new[start]:
+        start += 1
+    original_end, new_end = len(original), len(new)
+    while original_end > start and new_end > start and original[original_end - 1] == new[new_end - 1]:
+        original_end -= 1
+        new_end -= 1
+    middle_original = original[start:original_end]
+    middle_new = new[start:new_end]
+
+    if len(middle_original) * len(middle_new) <= MAX_ALIGNMENT_COST:
+        matcher = SequenceMatcher(None, [_element_key(v) for v in middle_original],
+                                  [_element_key(v) for v in middle_new], autojunk=False)
+        opcodes = matcher.get_opcodes()
+    else:
+        common = min(len(middle_original), len(middle_new))
+        opcodes = [('replace', 0, common, 0, common)]
+        if len(middle_original) > common:
+            opcodes.append(('delete', common, len(middle_original), common, common))
+        elif len(middle_new) > common:
+            opcodes.append(('insert', common, common, common, len(middle_new)))
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            continue
+        paired = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+        for offset in range(paired):
+            _diff(middle_original[i1 + offset], middle_new[j1 + offset], f'{path}[{start + j1 + offset}]', None,
+                  changes)
+        for i in range(i1 + paired, i2):
+            changes.append({'kind': 'removed', 'path': f'{path}[{start + i}]', 'original': middle_original[i],
+                            'new': None})
+        for j in range(j1 + paired, j2):
+            changes.append({'kind': 'added', 'path': f'{path}[{start + j}]', 'original': None,
+                            'new': middle_new[j]})
+
+
+def diff_values(original, new):
+    """
+    Compare two values in a single traversal.
+
+    Dicts and lists are compared structurally (list elements are aligned, so an insertion is reported once),
+    and strings holding JSON or form-encoded bodies are parsed and compared only when they differ.
+
+    :return: None if the values are equal, otherwise the list of changes, each a dict with 'kind'
+             ('added', 'removed' or 'changed'), 'path', 'original' and 'new'
+    """
+    changes = []
+    _diff(original, new, '', None, changes)
+    return changes or None
+
+
+def _normalize(value, key=None):
+    if isinstance(value, dict):
+        return {k: _normalize(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if key == 'body' and isinstance(value, str) and value:
+        parsed = _parse_body(value, key)
+        if parsed is not None:
+            return _normalize(parsed)
+    return value
+
+
+def flatten(value, path='', leaves=None):
+    """
+    Flatten a value into a {path: leaf value} dict, JSON and form-encoded bodies being flattened by content.
+    """
+    if leaves is None:
+        leaves = {}
+        value = _normalize(value)
+    if isinstance(value, dict) and value:
+        for k, v in value.items():
+            flatten(v, _join(path, k), leaves)
+    elif isinstance(value, list) and value:
+        for i, v in enumerate(value):
+            flatten(v, f'{path}[{i}]', leaves)
+    else:
+        leaves[path] = _element_key(value)
+    return leaves
+
+
+def similarity(original_leaves, new_leaves):
+    """
+    Share of the leaves of two flattened values that are present and equal in both.
+    :return: A score between 0 (nothing in common) and 1 (equal)
+    """
+    if not original_leaves and not new_leaves:
+        return 1.0
+    equal = sum(1 for path, value in original_leaves.items() if new_leaves.get(path) == value)
+    return equal / (len(original_leaves) + len(new_leaves) - equal)
+
+
+def fingerprint(value, normalize_body=True):
+    """
+    Stable content hash of a value: keys are sorted and, unless normalize_body is False, JSON and form-encoded
+    bodies are hashed by their parsed content. Values with the same fingerprint have no diff_values changes.
+    A repeated form key takes part in the hash with all its values, in order:
+
+    >>> fingerprint({'body': 'b=2&a=1'}) == fingerprint({'body': 'a=1&b=2'})
+    True
+    >>> fingerprint({'body': 'a=1&a=2'}) == fingerprint({'body': 'a=2'})
+    False
+    >>> fingerprint({'body': 'a=1&a=2'}) == fingerprint({'body': 'a=2&a=1'})
+    False
+    >>> fingerprint({'body': 'a=1&a=2'}) == fingerprint({'body': {'a': ['1', '2']}})
+    True
+
+    :return: A hex digest
+    """
+    if normalize_body:
+        value = _normalize(value)
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode('utf-8', errors='surrogatepass'), digest_size=16).hexdigest()
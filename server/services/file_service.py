@@ -1,33 +1,79 @@
 import json
+import logging
 import os
+import time
 
+from services.schema_filter import SchemaProjector
 
-def load_schema(app_name: str):
-    try:
-        init_folder('schema')
+# Seconds between two checks of the schema file modification time
+SCHEMA_CHECK_INTERVAL = 1.0
+
+_schema_cache = {}
+
+logger = logging.getLogger(__name__)
 
-        schema_path = './schema/' + app_name + '.json'
 
+def _read_schema(schema_path):
+    try:
         with open(schema_path, 'r', encoding='utf-8') as schema_file:
             schema = json.load(schema_file)
     except FileNotFoundError:
-        print("Schema file not found. Saving full data.")
+        logger.warning("Schema file not found. Saving full data.")
         schema = {
             'request': True,
             'response': True
         }
     except json.JSONDecodeError:
-        print("Error decoding schema file. Saving full data.")
+        logger.warning("Error decoding schema file. Saving full data.")
         schema = {
             'request': True,
             'response': True
         }
     return schema
 
+
+def _schema_entry(app_name: str):
+    """
+    Return the cache entry of a schema, reloading it when the file modification time changed.
+    """
+    entry = _schema_cache.get(app_name)
+    now = time.monotonic()
+    if entry is not None and now - entry['checked'] < SCHEMA_CHECK_INTERVAL:
+        return entry
+
+    schema_path = './schema/' + app_name + '.json'
+    try:
+        mtime = os.stat(schema_path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    if entry is None or entry['mtime'] != mtime:
+        init_folder('schema')
+        entry = {'mtime': mtime, 'schema': _read_schema(schema_path), 'projectors': {}}
+        _schema_cache[app_name] = entry
+    entry['checked'] = now
+    return entry
+
+
+def load_schema(app_name: str):
+    return _schema_entry(app_name)['schema']
+
+
+def load_projector(app_name: str, part: str):
+    """
+    Return the projector compiled from a part ('request' or 'response') of the schema of an app.
+    """
+    entry = _schema_entry(app_name)
+    projector = entry['projectors'].get(part)
+    if projector is None:
+        projector = SchemaProjector(entry['schema'].get(part, {}))
+        entry['projectors'][part] = projector
+    return projector
+
 def init_folder(folder_type: str, app_name=None):
     path = None
     if folder_type == 'schema':
         path = './schema'
 
     if not os.path.exists(path):
-        os.makedirs(path)
\ No newline at end of file
+        os.makedirs(path)
@@ -0,0 +1,143 @@
+import atexit
+import logging
+import os
+import shutil
+import threading
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+
+class JunitReportWriter:
+    """
+    Append-only JUnit report writer.
+
+    Every finished testcase is appended to the report file as soon as it is recorded, so the cost of a request does
+    not grow with the session. The pending testcases (requests that were not reached yet) and the closing tag are only
+    written when the report is flushed, which happens on a background interval, on demand, or at process exit.
+    """
+
+    def __init__(self, report_path, suite_name, tests, pending=None, mirror_path=None, flush_interval=5.0):
+        """
+        :param report_path: Path of the report file
+        :param suite_name: Name of the testsuite
+        :param tests: Number of tests announced in the testsuite
+        :param pending: Optional callable returning the testcases to add at the end of the report when flushing
+        :param mirror_path: Optional path where a copy of the report is made on every flush
+        :param flush_interval: Seconds between background flushes, 0 to only flush on demand
+        """
+        self.report_path = report_path
+        self.mirror_path = mirror_path
+        self.pending = pending
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dirty = True
+        self.tail_written = False
+
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        self.file = open(report_path, 'w+b')
+        header = ET.tostring(ET.Element('testsuite', name=suite_name, tests=str(tests)), encoding='unicode')
+        # ET serializes an empty element as "<testsuite ... />", keep it open for the testcases
+        self.file.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+        self.file.write(header.replace(' />', '>').encode('utf-8') + b'\n')
+        self.body_end = self.file.tell()
+
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        if flush_interval:
+            self.flush_thread = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+            self.flush_thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _serialize(testcase):
+        ET.indent(testcase, space='  ', level=1)
+        return b'  ' + ET.tostring(testcase, encoding='utf-8', xml_declaration=False) + b'\n'
+
+    def add_testcase(self, testcase: ET.Element):
+        """
+        Append a finished testcase to the report.
+        """
+        data = self._serialize(testcase)
+        with self.lock:
+            if self.closed:
+                return
+            if self.tail_written:
+                self.file.seek(self.body_end)
+                self.file.truncate()
+                self.tail_written = False
+            self.file.write(data)
+            self.body_end = self.file.tell()
+            self.dirty = True
+
+    def flush(self):
+        """
+        Write the pending testcases and the closing tag so the report on disk is a complete document.
+        """
+        with self.lock:
+            if self.closed or not self.dirty:
+                return
+            self.file.seek(self.body_end)
+            self.file.truncate()
+            if self.pending is not None:
+                for testcase in self.pending():
+                    self.file.write(self._serialize(testcase))
+            self.file.write(b'</testsuite>\n')
+            self.file.flush()
+            self.tail_written = True
+            self.dirty = False
+            if self.mirror_path:
+                shutil.copyfile(self.report_path, self.mirror_path)
+        logger.debug('Current JUnit report generated at %s', self.report_path)
+
+    def _flush_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        # The exit hook would keep the closed report, and the matcher behind pending, alive for the rest of the process
+        atexit.unregister(self.close)
+        self.stop_event.set()
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.file.close()
+
+
+def merge_reports(report_paths, output_path, name='HTTP Request Comparison'):
+    """
+    Merge the JUnit reports of several shards into one <testsuites> document, keeping one testsuite per shard.
+    Reports that can not be parsed (a shard still writing its first testcase) are skipped.
+    :return: The numbers of tests and failures of the merged report
+    """
+    suites = ET.Element('testsuites', name=name)
+    tests = failures = 0
+    for report_path in report_paths:
+        try:
+            suite = ET.parse(report_path).getroot()
+        except (OSError, ET.ParseError) as e:
+            logger.warning("Skipping the report %s: %s", report_path, e)
+            continue
+        testcases = suite.findall('testcase')
+        suite_failures = sum(1 for testcase in testcases if testcase.find('failure') is not None)
+        suite.set('tests', str(len(testcases)))
+        suite.set('failures', str(suite_failures))
+        tests += len(testcases)
+        failures += suite_failures
+        suites.append(suite)
+    suites.set('tests', str(tests))
+    suites.set('failures', str(failures))
+    ET.indent(suites, space='  ')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    ET.ElementTree(suites).write(output_path, encoding='utf-8', xml_declaration=True)
+    return tests, failures
+
+
+def find_shard_reports(run_path, report_name='junit_report.xml'):
+    """
+    Return the reports of the shards of a run, kept in one sub-directory per session.
+    """
+    return sorted(os.path.join(run_path, entry, report_name) for entry in os.listdir(run_path)
+                  if os.path.isfile(os.path.join(run_path, entry, report_name)))
@@ -0,0 +1,90 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+
+# Level of the shift loggers: DEBUG adds the (truncated) payloads of the exchanges to the logs
+LOG_LEVEL = os.getenv('SHIFT_LOG_LEVEL', 'INFO').upper()
+# Maximum length of a payload written to the logs
+MAX_PAYLOAD_LENGTH = int(os.getenv('SHIFT_LOG_PAYLOAD', '512'))
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(processName)s] %(name)s: %(message)s'
+
+_listener = None
+_handler = None
+
+
+def truncate(value, limit=None):
+    """
+    Render a payload for the logs on a single line, cut to limit characters.
+    """
+    limit = MAX_PAYLOAD_LENGTH if limit is None else limit
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        text = repr(bytes(value[:limit + 1]))
+    elif isinstance(value, str):
+        text = value
+    else:
+        try:
+            text = json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str)
+        except (TypeError, ValueError):
+            text = repr(value)
+    text = text.replace('\n', '\\n')
+    if len(text) > limit:
+        return f'{text[:limit]}... ({len(text) - limit} more)'
+    return text
+
+
+def _start_listener():
+    global _listener
+    # The records are formatted and written by a background thread, logging only enqueues them
+    _handler.queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def stop_logging():
+    """
+    Write the queued records, for processes about to leave without running the exit handlers.
+    """
+    global _listener
+    _stop_listener()
+    _listener = None
+
+
+def _restart_in_child(handler):
+    _start_listener()
+    # Child processes leave with os._exit, the queued records are written by the multiprocessing finalizers
+    multiprocessing.util.Finalize(None, _stop_listener, exitpriority=0)
+
+
+def setup_logging(level=None):
+    """
+    Route the logs of the process through a queue, so writing them never blocks the caller.
+    Calling it again only changes the level, if one is given.
+    :param level: Name of the level, SHIFT_LOG_LEVEL by default
+    """
+    global _handler
+    root = logging.getLogger()
+    if _handler is not None:
+        if level:
+            root.setLevel(level)
+        return
+    root.setLevel(level or LOG_LEVEL)
+    _handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    root.addHandler(_handler)
+    _start_listener()
+    atexit.register(_stop_listener)
+    # The listener thread does not survive a fork, worker processes start their own
+    multiprocessing.util.register_after_fork(_handler, _restart_in_child)
+    # The request lines of the Flask development server would double the line logged per exchange
+    logging.getLogger('werkzeug').setLevel(logging.INFO if root.level <= logging.DEBUG else logging.WARNING)
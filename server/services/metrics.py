@@ -0,0 +1,159 @@
+import contextlib
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Stage timings and latency histograms are only collected with SHIFT_METRICS=on, counters are always kept
+METRICS_ENABLED = os.getenv('SHIFT_METRICS', 'off') == 'on'
+# With SHIFT_PROFILE=on every session is run under cProfile and the stats are dumped when it is closed
+PROFILE_ENABLED = os.getenv('SHIFT_PROFILE', 'off') == 'on'
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """
+    Counters, gauges and per-stage latency histograms of a replay session.
+
+    When disabled, span() returns a shared no-op context manager, so instrumented code only pays for a method call.
+    """
+
+    def __init__(self, enabled=None, profile=None):
+        self.enabled = METRICS_ENABLED if enabled is None else enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.profiler = cProfile.Profile() if (PROFILE_ENABLED if profile is None else profile) else None
+        self.profile_lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, read):
+        """
+        Register a gauge, read is called when the metrics are collected.
+        """
+        self.gauges[name] = read
+
+    def span(self, stage):
+        """
+        Context manager timing a stage into its histogram.
+        """
+        return _Span(self, stage) if self.enabled else _NO_SPAN
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def profiling(self):
+        """
+        Run the block under the session profiler, if profiling is enabled. cProfile only follows the thread that
+        enabled it, so profiled blocks are serialized.
+        """
+        if self.profiler is None:
+            yield
+            return
+        with self.profile_lock:
+            self.profiler.enable()
+            try:
+                yield
+            finally:
+                self.profiler.disable()
+
+    def dump_profile(self, file_path):
+        """
+        Write the collected profile (pstats format) if profiling is enabled.
+        """
+        if self.profiler is None:
+            return None
+        with self.profile_lock:
+            self.profiler.dump_stats(file_path)
+        return file_path
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+        gauges = {name: read() for name, read in self.gauges.items()}
+        return {'counters': counters, 'gauges': gauges, 'stages': histograms}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def format_prometheus(snapshots):
+    """
+    Render metric snapshots in the Prometheus text exposition format.
+    :param snapshots: List of (labels, snapshot) pairs, one per session
+    """
+    families = {}
+    for labels, snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            families.setdefault((f'shift_{name}_total', 'counter'), []).append(
+                f'shift_{name}_total{_labels(labels)} {value}')
+        for name, value in snapshot['gauges'].items():
+            families.setdefault((f'shift_{name}', 'gauge'), []).append(f'shift_{name}{_labels(labels)} {value}')
+        for stage, histogram in snapshot['stages'].items():
+            lines = families.setdefault(('shift_stage_seconds', 'histogram'), [])
+            stage_labels = {**labels, 'stage': stage}
+            for bound, count in histogram['buckets']:
+                lines.append(f'shift_stage_seconds_bucket{_labels({**stage_labels, "le": bound})} {count}')
+            lines.append(f'shift_stage_seconds_sum{_labels(stage_labels)} {histogram["sum"]}')
+            lines.append(f'shift_stage_seconds_count{_labels(stage_labels)} {histogram["count"]}')
+
+    output = []
+    for (name, kind), lines in families.items():
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(lines)
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,105 @@
+import struct
+
+_PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+_PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+_PCAPNG_INTERFACE = 1
+_PCAPNG_SIMPLE_PACKET = 3
+_PCAPNG_ENHANCED_PACKET = 6
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def _iter_pcap(f, magic):
+    endian, resolution = _PCAP_MAGIC[magic]
+    header = _read_exact(f, 20)
+    linktype = struct.unpack(endian + 'I', header[16:20])[0] & 0x0fffffff
+    record_header = struct.Struct(endian + 'IIII')
+    while True:
+        try:
+            seconds, fraction, captured, _ = record_header.unpack(_read_exact(f, 16))
+            data = _read_exact(f, captured)
+        except EOFError:
+            return
+        yield seconds + fraction * resolution, linktype, data
+
+
+def _tsresol(options, endian):
+    """
+    Read the if_tsresol option of an interface description block.
+    """
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = options[offset + 4]
+            return 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _iter_pcapng(f):
+    endian = '<'
+    interfaces = []
+    first = True
+    while True:
+        try:
+            head = _read_exact(f, 8)
+        except EOFError:
+            return
+        block_type = struct.unpack('<I', head[:4])[0]
+        if block_type == _PCAPNG_SECTION_HEADER:
+            byte_order = _read_exact(f, 4)
+            endian = '<' if byte_order == b'\x4d\x3c\x2b\x1a' else '>'
+            length = struct.unpack(endian + 'I', head[4:8])[0]
+            _read_exact(f, length - 12)
+            interfaces = []
+            first = False
+            continue
+        if first:
+            return
+        block_type, length = struct.unpack(endian + 'II', head)
+        try:
+            body = _read_exact(f, length - 8)
+        except EOFError:
+            return
+        if block_type == _PCAPNG_INTERFACE:
+            linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+            interfaces.append((linktype, _tsresol(body[8:-4], endian)))
+        elif block_type == _PCAPNG_ENHANCED_PACKET:
+            interface, high, low, captured = struct.unpack_from(endian + 'IIII', body, 0)
+            if interface >= len(interfaces):
+                continue
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32) | low) * resolution, linktype, body[20:20 + captured]
+        elif block_type == _PCAPNG_SIMPLE_PACKET and interfaces:
+            linktype, _ = interfaces[0]
+            original = struct.unpack_from(endian + 'I', body, 0)[0]
+            yield 0.0, linktype, body[4:4 + original]
+
+
+def iter_capture_file(file_path):
+    """
+    Stream the frames of a pcap or pcapng file without loading it in memory.
+    :return: An iterator of (timestamp, linktype, frame bytes) tuples
+    """
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+        if magic in _PCAP_MAGIC:
+            yield from _iter_pcap(f, magic)
+        elif magic == b'\x0a\x0d\x0d\x0a':
+            f.seek(0)
+            yield from _iter_pcapng(f)
+        else:
+            raise ValueError(f"{file_path} is not a pcap or pcapng file")
@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+PCAP_MODES = ('scapy', 'raw', 'off')
+DEFAULT_PCAP_MODE = os.getenv('SHIFT_PCAP_MODE', 'scapy')
+DEFAULT_FLUSH_INTERVAL = float(os.getenv('SHIFT_PCAP_FLUSH_INTERVAL', '1.0'))
+
+LINKTYPE_ETHERNET = 1
+_GLOBAL_HEADER = struct.Struct('<IHHiIII')
+_RECORD_HEADER = struct.Struct('<IIII')
+_ETHERNET_HEADER = b'\x00' * 12 + b'\x08\x00'
+_IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_TCP_HEADER = struct.Struct('!HHIIBBHHH')
+
+logger = logging.getLogger(__name__)
+
+
+def frame_address(address):
+    """
+    Return the IPv4 address written in a frame for the address of a request. Flask reports the Host header as
+    destination: its port is dropped, and hostnames are replaced by 0.0.0.0 rather than resolved.
+    """
+    host = str(address).split(':', 1)[0]
+    try:
+        socket.inet_aton(host)
+    except OSError:
+        return '0.0.0.0'
+    return host
+
+
+def _ip_bytes(address):
+    return socket.inet_aton(frame_address(address))
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_tcp_frame(source_ip, destination_ip, source_port, destination_port, payload, flags=0x18):
+    """
+    Build a raw Ethernet/IPv4/TCP frame around a payload without going through scapy's layers.
+    The TCP checksum is left empty, which Wireshark reports but still dissects.
+    """
+    total_length = 20 + 20 + len(payload)
+    ip_header = _IP_HEADER.pack(0x45, 0, total_length & 0xffff, 0, 0x4000, 64, 6, 0,
+                                _ip_bytes(source_ip), _ip_bytes(destination_ip))
+    ip_header = ip_header[:10] + struct.pack('!H', _checksum(ip_header)) + ip_header[12:]
+    tcp_header = _TCP_HEADER.pack(int(source_port or 0), int(destination_port or 0), 0, 0, 5 << 4, flags, 65535, 0, 0)
+    return _ETHERNET_HEADER + ip_header + tcp_header + payload
+
+
+class PcapStreamWriter:
+    """
+    Long-lived pcap writer fed through a bounded queue and drained by a background thread.
+
+    Frames can be raw bytes or scapy packets; scapy packets are only serialized in the background thread.
+    The file is flushed in batches every flush_interval seconds instead of on every frame.
+    """
+
+    def __init__(self, file_path, mode=None, flush_interval=None, max_queue=10000, linktype=LINKTYPE_ETHERNET):
+        """
+        :param file_path: Path of the pcap file, frames are appended if it already exists
+        :param mode: One of PCAP_MODES, 'off' disables the output entirely
+        :param flush_interval: Seconds between two flushes of the file
+        :param max_queue: Maximum number of frames waiting to be written
+        """
+        self.file_path = file_path
+        self.mode = mode or DEFAULT_PCAP_MODE
+        if self.mode not in PCAP_MODES:
+            raise ValueError(f"Unknown pcap mode {self.mode}, expected one of {', '.join(PCAP_MODES)}")
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.linktype = linktype
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self._drain, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    @property
+    def raw(self):
+        return self.mode == 'raw'
+
+    def write(self, frame, timestamp=None):
+        """
+        Queue a frame to be written.
+        :param frame: Raw frame bytes or a scapy packet
+        :param timestamp: Capture time of the frame, defaults to now
+        """
+        if not self.enabled or self.closed or not self.thread.is_alive():
+            # A drain thread that died (unwritable file) would leave the writers blocked on a full queue
+            return
+        self.queue.put((frame, time.time() if timestamp is None else float(timestamp)))
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        exists = os.path.isfile(self.file_path) and os.path.getsize(self.file_path) > 0
+        f = open(self.file_path, 'ab')
+        if not exists:
+            f.write(_GLOBAL_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, self.linktype))
+        return f
+
+    def _drain(self):
+        with self._open() as f:
+            last_flush = time.monotonic()
+            running = True
+            while running:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ()
+                while item is not None:
+                    if item:
+                        self._write_frame(f, *item)
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if item is None:
+                    running = False
+                if time.monotonic() - last_flush >= self.flush_interval or not running:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+    def _write_frame(self, f, frame, timestamp):
+        # A frame that can not be written is dropped, the thread keeps draining the queue so writers never block
+        try:
+            data = frame if isinstance(frame, (bytes, bytearray, memoryview)) else bytes(frame)
+            seconds = int(timestamp)
+            f.write(_RECORD_HEADER.pack(seconds, int((timestamp - seconds) * 1000000), len(data), len(data)) + data)
+        except Exception:
+            logger.exception("Could not write a frame to %s", self.file_path)
+
+    def close(self):
+        """
+        Write every queued frame and close the file.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        # The exit hook would keep the closed writer and its buffers alive for the rest of the process
+        atexit.unregister(self.close)
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,235 @@
+import atexit
+import json
+import logging
+import os
+import shutil
+import time
+from collections import deque
+
+from services.blob_store import BLOB_FILE, DEFAULT_BLOB_THRESHOLD, body_digest
+from services.dict_utils import diff_values, fingerprint
+from services.file_service import load_projector
+from services.recording_store import (INDEX_SUFFIX, KEYS_SUFFIX, LEGACY_RECORDING_FILE, VOLATILE_FIELDS,
+                                      RecordingWriter, iter_recording, record_key, recording_file_name,
+                                      recording_path)
+
+# Delta layers of a recording are kept in <app>/layers/<timestamp>, applied in timestamp order over the base
+LAYERS_DIR = 'layers'
+# Sequence of a layer: {'base': position, ...volatile fields} for an exchange of the recording below it,
+# {'delta': position} for an exchange stored in the layer recording
+LAYER_FILE = 'layer.jsonl'
+SUMMARY_FILE = 'summary.json'
+
+logger = logging.getLogger(__name__)
+
+
+def layer_paths(directory):
+    """
+    Return the directories of the delta layers of a recording, oldest first.
+    """
+    layers_path = os.path.join(directory, LAYERS_DIR)
+    if not os.path.isdir(layers_path):
+        return []
+    # A layer without entries (re-capture stopped before any exchange) would empty the recording
+    names = [name for name in os.listdir(layers_path)
+             if name.isdigit() and os.path.isfile(os.path.join(layers_path, name, LAYER_FILE))
+             and os.path.getsize(os.path.join(layers_path, name, LAYER_FILE)) > 0]
+    return [os.path.join(layers_path, name) for name in sorted(names, key=int)]
+
+
+def _stable(data, part):
+    return {k: v for k, v in data.items() if k not in VOLATILE_FIELDS[part]}
+
+
+def _volatile(record):
+    return {part: {k: record[part][k] for k in fields if k in record[part]} for part, fields in VOLATILE_FIELDS.items()}
+
+
+def apply_layer(records, layer_path):
+    """
+    Apply a delta layer to the exchanges of the recording below it.
+    :return: The exchanges of the recording with the layer applied
+    """
+    deltas = list(iter_recording(layer_path))
+    layered = []
+    with open(os.path.join(layer_path, LAYER_FILE), 'r', encoding='utf-8') as f:
+        for line in f:
+            # A last line without newline is an entry being written
+            if not line.endswith('\n'):
+                break
+            entry = json.loads(line)
+            if 'base' in entry:
+                base = records[entry['base']]
+                layered.append({part: {**base[part], **entry.get(part, {})} for part in ('request', 'response')})
+            else:
+                layered.append(deltas[entry['delta']])
+    if not layered:
+        logger.warning("Layer %s has no entries, ignoring it", layer_path)
+        return records
+    return layered
+
+
+def load_layered_recording(directory):
+    """
+    Return the exchanges of a recording with all its delta layers applied.
+    """
+    records = list(iter_recording(directory))
+    for layer_path in layer_paths(directory):
+        records = apply_layer(records, layer_path)
+    return records
+
+
+class LayerWriter:
+    """
+    Re-capture of an app on top of its existing recording.
+
+    Captured exchanges are matched against the recording (with its layers applied) by the fingerprint of their
+    schema-projected request, in recording order. An exchange whose projected response is unchanged is stored as a
+    reference to the recording, new and changed exchanges are stored in the layer recording. The summary of the
+    layer lists the changed, new and no longer captured exchanges for review.
+    """
+
+    def __init__(self, directory, app_name):
+        self.directory = directory
+        self.request_projector = load_projector(app_name, 'request')
+        self.response_projector = load_projector(app_name, 'response')
+        self.records = load_layered_recording(directory)
+        # Positions of the recorded exchanges not matched yet, by request fingerprint
+        self.waiting = {}
+        for position, record in enumerate(self.records):
+            self.waiting.setdefault(self.request_fingerprint(record['request']), deque()).append(position)
+        self.layer_path = os.path.join(directory, LAYERS_DIR, str(int(time.time())))
+        # The layer is only created with its first exchange
+        self.deltas = None
+        self.layer_file = None
+        self.count = 0
+        self.stats = {'unchanged': 0, 'changed': 0, 'new': 0}
+        self.changes = []
+        self.closed = False
+        atexit.register(self.close)
+
+    def _open(self):
+        os.makedirs(self.layer_path, exist_ok=True)
+        # Large bodies go to the blob file of the recording, so compacting the layer keeps their references valid
+        self.deltas = RecordingWriter(os.path.join(self.layer_path, recording_file_name()), dedupe=True, blobs=True,
+                                      blob_path=os.path.join(self.directory, BLOB_FILE))
+        self.layer_file = open(os.path.join(self.layer_path, LAYER_FILE), 'a', encoding='utf-8')
+
+    def request_fingerprint(self, request_data):
+        request_data = _stable(request_data, 'request')
+        request_data.setdefault('body', '')
+        return fingerprint(self.request_projector.project(request_data))
+
+    def comparable_response(self, response_data):
+        """
+        Project a response with the schema. Bodies stored in the blob file, binary and large bodies are compared
+        by their sha256, other bodies by their content.
+        """
+        response_data = _stable(response_data, 'response')
+        body = response_data.get('body')
+        if isinstance(body, dict) and body.get('encoding') == 'utf-8' and \
+                len(body.get('data', '')) <= DEFAULT_BLOB_THRESHOLD:
+            response_data['body'] = body['data']
+        elif body is not None and not isinstance(body, str):
+            response_data['body'] = {'sha256': body_digest(body)}
+        return self.response_projector.project(response_data)
+
+    def append(self, record):
+        """
+        Store a captured exchange in the layer.
+        :return: A (status, position) tuple, status being 'unchanged', 'changed' or 'new' and position the matched
+                 exchange of the recording (None for a new exchange)
+        """
+        if self.layer_file is None:
+            self._open()
+        waiting = self.waiting.get(self.request_fingerprint(record['request']))
+        position = waiting.popleft() if waiting else None
+        if position is None:
+            status = 'new'
+        else:
+            original = self.comparable_response(self.records[position]['response'])
+            new = self.comparable_response(record['response'])
+            status = 'unchanged' if fingerprint(original) == fingerprint(new) else 'changed'
+
+        if status == 'unchanged':
+            entry = {'base': position, **_volatile(record)}
+        else:
+            change = {'index': self.count, 'status': status, 'key': record_key(record)}
+            if status == 'changed':
+                change['base'] = position
+                change['diff'] = diff_values(original, new)
+            self.changes.append(change)
+            self.deltas.append(record)
+            entry = {'delta': self.deltas.count - 1}
+        self.layer_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.layer_file.flush()
+        self.count += 1
+        self.stats[status] += 1
+        return status, position
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        if self.layer_file is None:
+            # Nothing was captured, only the pcap file of the re-capture may have been created
+            if os.path.isdir(self.layer_path):
+                shutil.rmtree(self.layer_path)
+            return
+        self.deltas.close()
+        self.layer_file.close()
+        removed = sorted(position for positions in self.waiting.values() for position in positions)
+        summary = {
+            'recorded': len(self.records),
+            'captured': self.count,
+            **self.stats,
+            'removed': len(removed),
+            'changes': self.changes,
+            'removed_exchanges': [{'base': position, 'key': record_key(self.records[position])}
+                                  for position in removed],
+        }
+        with open(os.path.join(self.layer_path, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=4)
+        logger.info("Re-capture layer %s: %d unchanged, %d changed, %d new and %d removed exchanges",
+                    self.layer_path, self.stats['unchanged'], self.stats['changed'], self.stats['new'], len(removed))
+
+
+def compact_recording(directory):
+    """
+    Merge the delta layers of a recording into its base recording and remove them.
+    :return: The path of the compacted recording, or None if the recording has no layers
+    """
+    layers = layer_paths(directory)
+    if not layers:
+        logger.info("%s has no layers to compact", directory)
+        return None
+    records = load_layered_recording(directory)
+
+    source_path = recording_path(directory)
+    if source_path is None or source_path.endswith(LEGACY_RECORDING_FILE):
+        file_name = recording_file_name()
+    else:
+        file_name = os.path.basename(source_path)
+    target_path = os.path.join(directory, file_name)
+    # Written next to the recording, so its bodies go to the same blob file
+    temp_path = os.path.join(directory, 'compact.' + file_name)
+    for suffix in ('', INDEX_SUFFIX, KEYS_SUFFIX):
+        if os.path.isfile(temp_path + suffix):
+            os.remove(temp_path + suffix)
+
+    writer = RecordingWriter(temp_path, fsync_every=1000000, fsync_interval=float('inf'), dedupe=True, blobs=True)
+    for record in records:
+        writer.append(record)
+    writer.close()
+
+    if source_path is not None and source_path != target_path:
+        os.remove(source_path)
+    for suffix in ('', INDEX_SUFFIX, KEYS_SUFFIX):
+        if os.path.isfile(temp_path + suffix):
+            os.replace(temp_path + suffix, target_path + suffix)
+        elif os.path.isfile(target_path + suffix):
+            os.remove(target_path + suffix)
+    shutil.rmtree(os.path.join(directory, LAYERS_DIR))
+    logger.info("Compacted %d layers into %s (%d exchanges)", len(layers), target_path, len(records))
+    return target_path
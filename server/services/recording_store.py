@@ -0,0 +1,538 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from bisect import bisect_right
+
+from services.blob_store import BLOB_FILE, BlobWriter
+from services.dict_utils import fingerprint
+
+RECORDING_FILE = 'packets.jsonl'
+COMPRESSED_RECORDING_FILE = 'packets.jsonl.gz'
+LEGACY_RECORDING_FILE = 'packets.json'
+
+RECORDING_FORMATS = ('jsonl', 'gzip')
+DEFAULT_RECORDING_FORMAT = os.getenv('SHIFT_RECORDING_FORMAT', 'jsonl')
+
+# Compressed recordings are a sequence of gzip members of at most BLOCK_RECORDS records or BLOCK_SIZE bytes,
+# each described by an (offset, length, first record, record count) entry of the index file
+INDEX_SUFFIX = '.idx'
+BLOCK_RECORDS = 64
+BLOCK_SIZE = 256 * 1024
+_INDEX_ENTRY = struct.Struct('<QQII')
+
+# Sidecar file of the [method, path] of every exchange, followed by the offset of its line in line-delimited
+# recordings, enough to index a recording without reading it. Writers end it with a {'size': ..., 'mtime_ns': ...}
+# stamp of the recording when they close, the offsets are only trusted while the recording matches the stamp.
+KEYS_SUFFIX = '.keys'
+
+# Fields that differ between repeats of the same exchange, kept in the reference records
+VOLATILE_FIELDS = {'request': ('timestamp', 'source_port'), 'response': ('timestamp', 'destination_port')}
+
+logger = logging.getLogger(__name__)
+
+
+def recording_file_name(recording_format=None):
+    recording_format = recording_format or DEFAULT_RECORDING_FORMAT
+    if recording_format not in RECORDING_FORMATS:
+        raise ValueError(f"Unknown recording format {recording_format}, "
+                         f"expected one of {', '.join(RECORDING_FORMATS)}")
+    return COMPRESSED_RECORDING_FILE if recording_format == 'gzip' else RECORDING_FILE
+
+
+def recording_path(directory):
+    """
+    Return the path of the recording stored in a directory, preferring the compressed and line-delimited formats.
+    :return: The path of the recording file, or None if the directory has no recording
+    """
+    for file_name in (COMPRESSED_RECORDING_FILE, RECORDING_FILE, LEGACY_RECORDING_FILE):
+        file_path = os.path.join(directory, file_name)
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+def _scan_blocks(file_path, blocks=None):
+    """
+    Rebuild the block index of a compressed recording by walking its gzip members, after the given blocks.
+    A truncated or damaged last member (interrupted write) is left out.
+    """
+    blocks = list(blocks or ())
+    offset = blocks[-1][0] + blocks[-1][1] if blocks else 0
+    first = blocks[-1][2] + blocks[-1][3] if blocks else 0
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        pending = b''
+        while True:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            start = offset
+            records = 0
+            while not decompressor.eof:
+                chunk = pending or f.read(64 * 1024)
+                pending = b''
+                if not chunk:
+                    return blocks
+                try:
+                    records += decompressor.decompress(chunk).count(b'\n')
+                except zlib.error:
+                    return blocks
+                if decompressor.eof:
+                    pending = decompressor.unused_data
+                    offset += len(chunk) - len(pending)
+                else:
+                    offset += len(chunk)
+            blocks.append((start, offset - start, first, records))
+            first += records
+
+
+def read_block_index(file_path):
+    """
+    Return the block index of a compressed recording. Members missing from the index file are found by walking
+    the data after the last indexed one.
+    """
+    index_path = file_path + INDEX_SUFFIX
+    size = os.path.getsize(file_path)
+    blocks = []
+    if os.path.isfile(index_path):
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % _INDEX_ENTRY.size
+        blocks = list(_INDEX_ENTRY.iter_unpack(data[:usable]))
+        end = blocks[-1][0] + blocks[-1][1] if blocks else 0
+        if end == size:
+            return blocks
+        if end > size:
+            blocks = []
+    return _scan_blocks(file_path, blocks)
+
+
+def _read_block(f, block):
+    f.seek(block[0])
+    data = zlib.decompress(f.read(block[1]), zlib.MAX_WBITS | 16)
+    return [line for line in data.split(b'\n') if line.strip()]
+
+
+def iter_raw_records(file_path):
+    """
+    Stream the records of a recording file as stored, {'ref': index} records of repeated exchanges unresolved.
+    """
+    if file_path.endswith(LEGACY_RECORDING_FILE):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+        return
+    if file_path.endswith('.gz'):
+        with open(file_path, 'rb') as f:
+            for block in read_block_index(file_path):
+                for line in _read_block(f, block):
+                    yield json.loads(line)
+        return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_recording(directory):
+    """
+    Stream the exchanges of a recording, one {'request': ..., 'response': ...} record at a time.
+    Legacy packets.json recordings (a single JSON array) are still readable.
+    """
+    file_path = recording_path(directory)
+    if file_path is None:
+        return
+    records = {}
+    for index, record in enumerate(iter_raw_records(file_path)):
+        yield resolve_record(record, index, records)
+
+
+def resolve_record(record, index, records):
+    """
+    Resolve a {'ref': index, ...} record written for a repeated exchange into a full record.
+    :param index: Position of the record in the recording
+    :param records: Full records read so far by position, updated with the record
+    """
+    ref = record.get('ref')
+    if ref is None:
+        records[index] = record
+        return record
+    base = records[ref]
+    return {part: {**base[part], **record.get(part, {})} for part in ('request', 'response')}
+
+
+def exchange_fingerprint(record):
+    """
+    Fingerprint of an exchange without the fields that change between repeats (timestamps, client port).
+    """
+    stable = {}
+    for part, fields in VOLATILE_FIELDS.items():
+        stable[part] = {k: v for k, v in record[part].items() if k not in fields}
+    return fingerprint(stable, normalize_body=False)
+
+
+def record_key(record):
+    return [record['request']['method'], record['request']['path']]
+
+
+def _recording_stamp(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _write_keys(file_path, keys, offsets=None, stamp=False):
+    keys_path = file_path + KEYS_SUFFIX
+    with open(keys_path + '.tmp', 'w', encoding='utf-8') as f:
+        for index, key in enumerate(keys):
+            entry = key + [offsets[index]] if offsets is not None else key
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        if stamp:
+            f.write(json.dumps(_recording_stamp(file_path)) + '\n')
+    os.replace(keys_path + '.tmp', keys_path)
+
+
+def _read_keys(file_path):
+    """
+    Read the keys file of a recording.
+    :return: A (keys, offsets, stamped) tuple, offsets being None when some entry has none and stamped telling
+             whether the recording still matches the stamp of the file, or None if the recording has no keys file
+    """
+    keys_path = file_path + KEYS_SUFFIX
+    if not os.path.isfile(keys_path):
+        return None
+    keys = []
+    offsets = []
+    stamp = None
+    with open(keys_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            # A last line without newline is an entry being written
+            if not line.endswith('\n'):
+                break
+            entry = json.loads(line)
+            if isinstance(entry, dict):
+                stamp = entry
+                break
+            keys.append(entry[:2])
+            if offsets is not None:
+                if len(entry) > 2:
+                    offsets.append(entry[2])
+                else:
+                    offsets = None
+    return keys, offsets, stamp is not None and stamp == _recording_stamp(file_path)
+
+
+def _scan_offsets(file_path):
+    offsets = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets.append(offset)
+            offset += len(line)
+    return offsets
+
+
+def read_recording_keys(reader):
+    """
+    Return the [method, path] of every exchange of a recording, from its keys file when it covers the recording.
+    The keys file is rebuilt otherwise, so only the first start after a change parses every record.
+    """
+    if reader.keys is not None:
+        return reader.keys
+    count = len(reader)
+    sidecar = _read_keys(reader.file_path) if reader.records is None else None
+    if sidecar is not None:
+        keys = sidecar[0][:count]
+        # The last exchange is checked so that a keys file left by another recording is not trusted
+        if len(keys) == count and (not count or keys[-1] == record_key(reader[count - 1])):
+            return keys
+
+    keys = []
+    for index in range(count):
+        record = reader.raw(index)
+        keys.append(keys[record['ref']] if 'ref' in record else record_key(record))
+    if reader.records is None:
+        _write_keys(reader.file_path, keys, reader.offsets, stamp=True)
+    return keys
+
+
+class RecordingReader:
+    """
+    Random access to the exchanges of a recording file.
+
+    Line-delimited recordings are indexed by line offset, read from the keys file when the recording matches its
+    stamp and in one pass otherwise. Compressed recordings are indexed through their block index, only the block
+    holding a record is decompressed and the last one is kept for sequential reads.
+    """
+
+    def __init__(self, file_path, records=None):
+        """
+        :param records: Exchanges of the recording already loaded (with its delta layers applied), read instead of
+                        the file
+        """
+        self.file_path = file_path
+        self.records = records
+        self.keys = None
+        self.offsets = None
+        self.blocks = None
+        self.cached_block = None
+        self.cached_lines = None
+        if records is None and file_path.endswith(LEGACY_RECORDING_FILE):
+            self.records = list(iter_raw_records(file_path))
+        if self.records is not None:
+            return
+        if file_path.endswith('.gz'):
+            self.blocks = read_block_index(file_path)
+            self.firsts = [block[2] for block in self.blocks]
+            self.count = sum(block[3] for block in self.blocks)
+            self.file = open(file_path, 'rb')
+        else:
+            sidecar = _read_keys(file_path)
+            if sidecar is not None and sidecar[2] and sidecar[1] is not None:
+                self.keys, self.offsets = sidecar[0], sidecar[1]
+            else:
+                self.offsets = _scan_offsets(file_path)
+            self.file = open(file_path, 'rb')
+
+    def __len__(self):
+        if self.records is not None:
+            return len(self.records)
+        if self.blocks is not None:
+            return self.count
+        return len(self.offsets)
+
+    def raw(self, index):
+        """
+        Return the record at a position as stored.
+        """
+        if self.records is not None:
+            return self.records[index]
+        if self.offsets is not None:
+            self.file.seek(self.offsets[index])
+            return json.loads(self.file.readline())
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        position = bisect_right(self.firsts, index) - 1
+        if self.cached_block != position:
+            self.cached_lines = _read_block(self.file, self.blocks[position])
+            self.cached_block = position
+        return json.loads(self.cached_lines[index - self.blocks[position][2]])
+
+    def __getitem__(self, index):
+        """
+        Return the exchange at a position, repeated exchanges resolved.
+        """
+        record = self.raw(index)
+        ref = record.get('ref')
+        if ref is None:
+            return record
+        return resolve_record(record, index, {ref: self.raw(ref)})
+
+    def close(self):
+        if self.records is None:
+            self.file.close()
+
+
+class RecordingWriter:
+    """
+    Append-only writer for line-delimited recordings, one JSON record per exchange.
+
+    Every record is handed to the OS as soon as it is appended, so a crash of the process loses nothing.
+    fsync is batched every fsync_every records or fsync_interval seconds.
+
+    Compressed recordings (a .gz file path) are written as independent gzip members of a few records with an index
+    of their offsets, readable by any gzip tool. A member is written when it is full or when the writer syncs.
+
+    With dedupe, an exchange identical to an earlier one (polling, heartbeats) is written as a small
+    {'ref': index} record holding only its volatile fields.
+
+    With blobs, large response bodies are written to the bodies.blob file next to the recording (or to blob_path)
+    and the record only keeps their reference.
+    """
+
+    def __init__(self, file_path, fsync_every=50, fsync_interval=2.0, dedupe=False, max_fingerprints=100000,
+                 blobs=False, blob_path=None):
+        self.file_path = file_path
+        self.compressed = file_path.endswith('.gz')
+        blob_path = blob_path or os.path.join(os.path.dirname(file_path), BLOB_FILE)
+        self.blobs = BlobWriter(blob_path) if blobs else None
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.dedupe = dedupe
+        self.max_fingerprints = max_fingerprints
+        self.fingerprints = {}
+        self.count = 0
+        self.deduplicated = 0
+        self.pending = []
+        self.pending_size = 0
+        self.index_file = None
+        self.keys = []
+        # Offsets of the records of a line-delimited recording, stored with their keys
+        self.offsets = None if self.compressed else []
+        self.offset = 0
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        if os.path.isfile(file_path):
+            self._scan_existing()
+        _write_keys(file_path, self.keys, self.offsets)
+        self.keys_file = open(file_path + KEYS_SUFFIX, 'a', encoding='utf-8')
+        self.file = open(file_path, 'ab')
+        if self.compressed:
+            self._open_index()
+        else:
+            self.offset = self.file.tell()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        atexit.register(self.close)
+
+    def _open_index(self):
+        """
+        Drop a truncated last member and rewrite the index of the members already in the file.
+        """
+        blocks = read_block_index(self.file_path) if self.count else []
+        end = blocks[-1][0] + blocks[-1][1] if blocks else 0
+        self.file.truncate(end)
+        self.file.seek(end)
+        self.offset = end
+        self.index_file = open(self.file_path + INDEX_SUFFIX, 'wb')
+        for block in blocks:
+            self.index_file.write(_INDEX_ENTRY.pack(*block))
+        self.index_file.flush()
+
+    def _scan_existing(self):
+        """
+        Count the records already in the file and index their keys, offsets, fingerprints and blobs.
+        """
+        if self.offsets is not None:
+            self.offsets = _scan_offsets(self.file_path)
+        for record in iter_raw_records(self.file_path):
+            self.keys.append(self.keys[record['ref']] if 'ref' in record else record_key(record))
+            if 'ref' not in record:
+                if self.dedupe and len(self.fingerprints) < self.max_fingerprints:
+                    self.fingerprints.setdefault(exchange_fingerprint(record), self.count)
+                body = record['response'].get('body')
+                if self.blobs and isinstance(body, dict) and body.get('encoding') == 'blob':
+                    self.blobs.register(body)
+            self.count += 1
+
+    def append(self, record):
+        """
+        :return: The index of the earlier identical record if the record was deduplicated, None otherwise
+        """
+        ref = record.get('ref')
+        key = self.keys[ref] if ref is not None else record_key(record)
+        self.keys.append(key)
+        if ref is None:
+            if self.blobs:
+                self.blobs.externalize(record['response'])
+            if self.dedupe:
+                digest = exchange_fingerprint(record)
+                ref = self.fingerprints.get(digest)
+                if ref is None:
+                    if len(self.fingerprints) < self.max_fingerprints:
+                        self.fingerprints[digest] = self.count
+                else:
+                    volatile = {part: {k: record[part][k] for k in fields if k in record[part]}
+                                for part, fields in VOLATILE_FIELDS.items()}
+                    record = {'ref': ref, **volatile}
+                    self.deduplicated += 1
+        self.count += 1
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8', errors='surrogatepass')
+        # The keys file can run ahead of the recording, readers only use the entries of the records present
+        self.keys_file.write(json.dumps(key if self.compressed else key + [self.offset], ensure_ascii=False) + '\n')
+        if self.compressed:
+            self.pending.append(line)
+            self.pending_size += len(line)
+            if len(self.pending) >= BLOCK_RECORDS or self.pending_size >= BLOCK_SIZE:
+                self._write_block()
+        else:
+            self.file.write(line)
+            self.file.flush()
+            self.offset += len(line)
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+        return ref
+
+    def _write_block(self):
+        if not self.pending:
+            return
+        member = gzip.compress(b''.join(self.pending), mtime=0)
+        self.file.write(member)
+        self.file.flush()
+        # The index entry is only written once its member is complete
+        self.index_file.write(_INDEX_ENTRY.pack(self.offset, len(member), self.count - len(self.pending),
+                                                len(self.pending)))
+        self.index_file.flush()
+        self.offset += len(member)
+        self.pending = []
+        self.pending_size = 0
+
+    def sync(self):
+        if self.file.closed:
+            return
+        if self.blobs:
+            self.blobs.sync()
+        if self.compressed:
+            self._write_block()
+            os.fsync(self.index_file.fileno())
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.keys_file.flush()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.file.closed:
+            return
+        atexit.unregister(self.close)
+        self.sync()
+        self.file.close()
+        # The keys file now describes the whole recording
+        self.keys_file.write(json.dumps(_recording_stamp(self.file_path)) + '\n')
+        self.keys_file.close()
+        if self.index_file:
+            self.index_file.close()
+        if self.blobs:
+            self.blobs.close()
+
+
+def open_recording_writer(directory, recording_format=None, **kwargs):
+    """
+    Open a writer appending to the recording of a directory, in its existing format or in the given one.
+    """
+    file_path = recording_path(directory)
+    if file_path is None or file_path.endswith(LEGACY_RECORDING_FILE):
+        file_path = os.path.join(directory, recording_file_name(recording_format))
+    return RecordingWriter(file_path, **kwargs)
+
+
+def convert_recording(directory, recording_format='gzip'):
+    """
+    Rewrite the recording of a directory in another format. Repeated exchanges keep their references and
+    large bodies of legacy recordings are moved to the blob file.
+    :return: The path of the new recording
+    """
+    source_path = recording_path(directory)
+    if source_path is None:
+        raise FileNotFoundError(f"No recording found in {directory}")
+    target_path = os.path.join(directory, recording_file_name(recording_format))
+    if source_path == target_path:
+        logger.info("%s is already in the %s format", source_path, recording_format)
+        return target_path
+
+    for stale_path in (target_path, target_path + INDEX_SUFFIX, target_path + KEYS_SUFFIX):
+        if os.path.isfile(stale_path):
+            os.remove(stale_path)
+    writer = RecordingWriter(target_path, fsync_every=1000000, fsync_interval=float('inf'), dedupe=True,
+                             blobs=True)
+    for record in iter_raw_records(source_path):
+        writer.append(record)
+    writer.close()
+
+    for old_path in (source_path, source_path + INDEX_SUFFIX, source_path + KEYS_SUFFIX):
+        if os.path.isfile(old_path):
+            os.remove(old_path)
+    logger.info("Converted %s (%d bytes) to %s", source_path, os.path.getsize(target_path), target_path)
+    return target_path
@@ -0,0 +1,147 @@
+import atexit
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+
+RUN_LOG_FILE = 'run.jsonl'
+INDEX_SUFFIX = '.idx'
+# (offset, length) of every entry of the run log
+_INDEX_ENTRY = struct.Struct('<QI')
+
+
+class RunLogWriter:
+    """
+    Append-only log of the exchanges replayed during a run: one JSON line per exchange in a single file, with an
+    index of the entry offsets next to it.
+
+    Entries are queued and serialized by a background thread, the file is flushed every flush_interval seconds.
+    """
+
+    def __init__(self, file_path, flush_interval=1.0, max_queue=10000):
+        self.file_path = file_path
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.count = 0
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, request_data, response_data):
+        """
+        Queue an exchange to be logged, the dicts must not be changed afterwards.
+        """
+        if self.closed:
+            return
+        self.queue.put({'time': datetime.now().strftime('%Y%m%d_%H%M%S_%f'),
+                        'request': request_data, 'response': response_data})
+
+    def _drain(self):
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        with open(self.file_path, 'ab') as f, open(self.file_path + INDEX_SUFFIX, 'ab') as index:
+            offset = f.tell()
+            last_flush = time.monotonic()
+            running = True
+            while running:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+                try:
+                    entry = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    entry = {}
+                while entry is not None:
+                    if entry:
+                        entry['index'] = self.count
+                        data = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8', errors='surrogatepass')
+                        f.write(data)
+                        index.write(_INDEX_ENTRY.pack(offset, len(data)))
+                        offset += len(data)
+                        self.count += 1
+                    try:
+                        entry = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if entry is None:
+                    running = False
+                if time.monotonic() - last_flush >= self.flush_interval or not running:
+                    f.flush()
+                    index.flush()
+                    last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Write every queued entry and close the log.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        # The exit hook would keep the closed log alive for the rest of the process
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join()
+
+
+class RunLogReader:
+    """
+    Random access to the entries of a run log. The index is rebuilt by scanning the log if it does not match it.
+    """
+
+    def __init__(self, file_path):
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, RUN_LOG_FILE)
+        self.file_path = file_path
+        self.entries = self._read_index()
+        self.file = open(file_path, 'rb')
+
+    def _read_index(self):
+        size = os.path.getsize(self.file_path)
+        index_path = self.file_path + INDEX_SUFFIX
+        if os.path.isfile(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            entries = list(_INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % _INDEX_ENTRY.size]))
+            end = entries[-1][0] + entries[-1][1] if entries else 0
+            if end == size:
+                return entries
+
+        entries = []
+        with open(self.file_path, 'rb') as f:
+            offset = 0
+            for line in f:
+                # A last line without newline is an entry being written
+                if line.endswith(b'\n'):
+                    entries.append((offset, len(line)))
+                offset += len(line)
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        offset, length = self.entries[index]
+        self.file.seek(offset)
+        return json.loads(self.file.read(length))
+
+    def __iter__(self):
+        for index in range(len(self.entries)):
+            yield self[index]
+
+    def close(self):
+        self.file.close()
+
+
+def export_run_log(file_path, output_dir):
+    """
+    Export a run log to the former layout, one packet_<timestamp>.json file per exchange.
+    :return: The number of exported files
+    """
+    reader = RunLogReader(file_path)
+    os.makedirs(output_dir, exist_ok=True)
+    for entry in reader:
+        with open(os.path.join(output_dir, f"packet_{entry['time']}.json"), 'w', encoding='utf-8') as f:
+            json.dump({'request': entry['request'], 'response': entry['response']}, f, ensure_ascii=False, indent=4)
+    reader.close()
+    return len(reader)
@@ -1,3 +1,48 @@
+def compile_schema(schema):
+    """
+    Compile a schema into a tuple of (key, sub-fields) pairs, sub-fields being None when the whole field is selected.
+
+    :param schema: Schema dictionary specifying allowed fields
+    :return: Compiled fields, or None if the schema selects the whole data
+    """
+    if not isinstance(schema, dict):
+        return None
+    fields = []
+    for key, value in schema.items():
+        if value is True:
+            fields.append((key, None))
+        elif isinstance(value, dict):
+            fields.append((key, compile_schema(value)))
+    return tuple(fields)
+
+
+def project(data, fields):
+    """
+    Extract the compiled fields from the input data in a single pass.
+    """
+    if fields is None or not isinstance(data, dict):
+        return data
+    projected = {}
+    for key, sub_fields in fields:
+        if key in data:
+            value = data[key]
+            projected[key] = value if sub_fields is None else project(value, sub_fields)
+    return projected
+
+
+class SchemaProjector:
+    """
+    Reusable projector compiled once from a schema.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.fields = compile_schema(schema)
+
+    def project(self, data):
+        return project(data, self.fields)
+
+
 def filter_data_by_schema(data, schema):
     """
     Filter the input data to only include fields specified in the schema.
@@ -6,20 +51,4 @@ def filter_data_by_schema(data, schema):
     :param schema: Schema dictionary specifying allowed fields
     :return: Filtered dictionary
     """
-    if not isinstance(data, dict):
-        return data
-
-    if not isinstance(schema, dict):
-        return data
-
-    filtered_data = {}
-    for key, value in schema.items():
-        if key in data:
-            # If the value is True, include the entire field
-            if value is True:
-                filtered_data[key] = data[key]
-            # If the value is a dictionary, recursively filter nested fields
-            elif isinstance(value, dict):
-                filtered_data[key] = filter_data_by_schema(data.get(key, {}), value)
-
-    return filtered_data
\ No newline at end of file
+    return project(data, compile_schema(schema))
@@ -1,3 +1,4 @@
+import json
 import xml.etree.ElementTree as ET
 
 def json_to_xml(json_data, parent=None, initial_name=None):
@@ -15,4 +16,18 @@ def json_to_xml(json_data, parent=None, initial_name=None):
             child = ET.Element(key)
             child.text = str(value)
             parent.append(child)
-    return parent
\ No newline at end of file
+    return parent
+
+def diff_to_xml(changes, initial_name='diff'):
+    parent = ET.Element(initial_name)
+    for change in changes:
+        child = ET.Element('change', kind=change['kind'], path=change['path'])
+        for side in ('original', 'new'):
+            if change[side] is None:
+                continue
+            value = change[side]
+            element = ET.Element(side)
+            element.text = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+            child.append(element)
+        parent.append(child)
+    return parent